@@ -13,17 +13,30 @@
 
 """
 Usage:
-	{prog} [options] --server-host=ADDRESS --log-file-path=PATH [--exclude-host=ADDRESS]...
+	{prog} [options] (--server-host=ADDRESS)... [--log-file-path=PATH] [--exclude-host=ADDRESS]...
+	{prog} [options] --local-file=PATH [--checkpoint=PATH] [--exclude-host=ADDRESS]...
 
 Options:
 	--oneline                           Stream logs in a compact format.
 	--since=DATE, -s DATE               Only show logs after specified date and time.
 	--exclude-host=ADDRESS, -x ADDRESS  Do not show logs initiated from specified IP addresses.
-	--server-host=ADDRESS, -h ADDRESS   The server hostname to get apache logs from.
-	--log-file-path=PATH, -p PATH       Path to the access log file on the specified remote host.
+	--server-host=ADDRESS, -h ADDRESS   The server hostname to get apache logs from, can be used multiple times to
+	                                    merge the logs of several servers. ADDRESS:PATH reads the log at PATH, which
+	                                    must be absolute. An IPv6 ADDRESS can be in brackets.
+	--log-file-path=PATH, -p PATH       Path to the access log file on the servers that don't specify one.
+	--merge-window=SECONDS              How far out of order by request time the merged logs of several servers can be
+	                                    and still be put in order, which is also the longest they are held back waiting
+	                                    for a server that is slow or has gone quiet [default: 2].
+	--local-file=PATH, -l PATH          Path to a local access log file to read instead of one on a server.
+	--checkpoint=PATH                   File to record how far --local-file was read in, and to resume from next time.
+	--no-follow                         Stop at the end of the log file instead of waiting for more lines.
+	--log-format=FORMAT, -f FORMAT      Apache LogFormat string of the log, or one of the nicknames common, combined
+	                                    and vhost_combined [default: combined].
+	--geoip-cache-size=COUNT            Number of client addresses to remember GeoIP details of [default: 65536].
 """
 
-import sys, locale, asyncio, subprocess, os, socket, datetime, re, json
+import sys, locale, asyncio, subprocess, os, socket, datetime, re, json, functools, mmap, pathlib, contextlib, heapq
+import collections, math
 import docopt
 import geoip2.database
 import dateparser
@@ -39,19 +52,34 @@ async def main(*, args, prog):
 		version=True,
 		options_first=False
 	)
-	server_host = params.pop("--server-host")
+	server_hosts = params.pop("--server-host")
 	log_file_path = params.pop("--log-file-path")
+	merge_window = float(params.pop("--merge-window"))
+	local_file_path = params.pop("--local-file")
+	checkpoint_path = params.pop("--checkpoint")
+	follow = not params.pop("--no-follow")
 	stream_oneline = params.pop("--oneline")
 	since_time = params.pop("--since")
 	exclude_hosts_addresses = params.pop("--exclude-host")
+	log_format = params.pop("--log-format")
+	geoip_cache_size = int(params.pop("--geoip-cache-size"))
 	if since_time:
 		since_time = dateparser.parse(since_time, settings={"RETURN_AS_TIMEZONE_AWARE": True})
 	assert not params, params
+	log_format = LOG_FORMATS.get(log_format, log_format)
 
-	log = asyncio.Queue()
+	log = asyncio.Queue(maxsize=OUTPUT_QUEUE_SIZE)
 	pending_tasks = []
+	log_file_reader = None
+	if local_file_path:
+		skip_before = None
+		if since_time:
+			line_p = compile_log_format(log_format)
+			is_before_since = make_log_time_filter(since_time - LOG_TIME_DISORDER)
+			skip_before = lambda line: (m := line_p.match(line)) is not None and is_before_since(m["time"])
+		log_file_reader = LogFileReader(local_file_path, follow=follow, checkpoint_path=checkpoint_path, skip_before=skip_before)
 	printer_task = asyncio.create_task(
-		printer(queue=log, fo=sys.stdout)
+		printer(queue=log, fo=sys.stdout, write_checkpoint=log_file_reader.write_checkpoint if log_file_reader else None)
 	)
 
 	#{
@@ -60,96 +88,319 @@ async def main(*, args, prog):
 	for a in exclude_hosts_addresses:
 		exclude_hosts.extend(socket.gethostbyname_ex(a)[2])
 
-	cmd = [
-		"ssh", server_host,
-		"tail", "--follow=name", "--lines=+0",
-		log_file_path,
-	]
-	p = await asyncio.create_subprocess_exec(
-		*cmd,
-		stdout=subprocess.PIPE,
-	)
-	pending_tasks.append(p.wait()) #TODO call p.terminate() at exit
-	pending_tasks.append(process_apache_access_log(
-		input_stream=p.stdout,
-		output_queue=log,
+	process_log = functools.partial(
+		process_apache_access_log,
 		exclude_hosts=exclude_hosts,
 		oneline=stream_oneline,
 		since=since_time,
-	))
+		log_format=log_format,
+	)
+	output = OutputBatcher(log, get_checkpoint=log_file_reader.get_position if log_file_reader else None)
+	with open_geoip_lookup(cache_size=geoip_cache_size) as lookup_geoip:
+		if log_file_reader is not None:
+			pending_tasks.append(process_log(input_stream=log_file_reader, output=output, lookup_geoip=lookup_geoip))
+		else:
+			hosts = []
+			for server_host in server_hosts:
+				# Addresses such as IPv6 ones can have colons, only an absolute path is split off the last one.
+				host, _, path = server_host.rpartition(":")
+				if not host or not path.startswith("/"):
+					host, path = server_host, None
+				if host.startswith("[") and host.endswith("]"):
+					host = host[1:-1]
+				assert path or log_file_path, ("No log file path for the server", host)
+				hosts.append((host, path or log_file_path))
+			merger = None
+			if len(hosts) > 1:
+				merger = LogMerger(output, window=merge_window)
+				pending_tasks.append(merger.run())
+			origin_width = max(len(host) for host, path in hosts)
+			for host, path in hosts:
+				cmd = [
+					"ssh", host,
+					"tail", *(["--follow=name"] if follow else []), "--lines=+0",
+					path,
+				]
+				p = await asyncio.create_subprocess_exec(
+					*cmd,
+					stdout=subprocess.PIPE,
+				)
+				pending_tasks.append(p.wait()) #TODO call p.terminate() at exit
+				pending_tasks.append(process_log(
+					input_stream=p.stdout,
+					output=merger.source(host) if merger else output,
+					lookup_geoip=lookup_geoip,
+					origin=host if merger else None,
+					origin_width=origin_width,
+				))
 
-	#}
+		#}
 
-	await asyncio.gather(*pending_tasks)
+		try:
+			# The queue is bounded, so if the printer fails, such as when the output is closed, nothing would take
+			# records from it anymore and the readers would wait for room forever.
+			readers = asyncio.gather(*pending_tasks)
+			await asyncio.wait([readers, printer_task], return_when=asyncio.FIRST_COMPLETED)
+			if printer_task.done():
+				readers.cancel()
+				with contextlib.suppress(asyncio.CancelledError):
+					await readers
+				printer_task.result()
+			await readers
+		finally:
+			if log_file_reader is not None:
+				log_file_reader.close()
 	current_task = asyncio.current_task()
 	all_tasks = asyncio.all_tasks()
 	assert {current_task, printer_task} == all_tasks, (current_task, all_tasks)
 
 	await log.put(None)
 	await printer_task
+	if log_file_reader is not None:
+		# Everything read has been printed, including the lines at the end that were skipped.
+		log_file_reader.write_checkpoint(log_file_reader.get_position())
 
 
-async def process_apache_access_log(*, input_stream, output_queue, exclude_hosts=None, oneline=False, since=None):
-	# LogFormat "%h %l %u %t \"%r\" %>s %O \"%{Referer}i\" \"%{User-Agent}i\"" combined
+async def process_apache_access_log(*, input_stream, output, lookup_geoip, exclude_hosts=None, oneline=False, since=None, log_format, origin=None, origin_width=0):
+	"""
+	Parses the log lines of input_stream and adds them formatted to output, with their time. Records are tagged with
+	`origin` if it's given.
+	"""
 	# http://httpd.apache.org/docs/current/mod/mod_log_config.html
-
-	line_p = re.compile(r"""^(?P<remote_hostname>\S+) (?P<remote_logname>\S+) (?P<remote_user>\S+) \[(?P<time>[^]]+)\] "(?P<request_first_line>[^"]+)" (?P<final_status>\S+) (?P<bytes_sent>\d+) "(?P<referrer>[^"]*)" "(?P<useragent>[^"]+)"\s*$""")
+	line_p = compile_log_format(log_format)
 	request_p = re.compile(r"""^(?P<method>\S+)\s+(?P<uri>.*)\s+(?P<httpversion>\S+)\s*$""")
+	assert "time" in line_p.groupindex, ("The log format has no %t", log_format)
+	client_field = "remote_hostname" if "remote_hostname" in line_p.groupindex else "remote_address"
+	assert client_field in line_p.groupindex, ("The log format has neither %h nor %a", log_format)
+
+	# Lines are matched as bytes and only the fields that are shown get decoded.
+	def get_field(line_m, name):
+		return decode_log_field(line_m[name]) if name in line_p.groupindex else None
+
+	exclude_hosts = set(h.encode() for h in exclude_hosts or [])
+	is_before_since = make_log_time_filter(since) if since else None
+	f_origin = f"{origin:{origin_width}} " if origin is not None else ""
 
 	def json_default(o):
 		if isinstance(o, datetime.datetime):
 			return o.isoformat()
 		raise TypeError(f"Object of type {o.__class__.__name__!r} is not JSON serializable")
 
+	while True:
+		line = await input_stream.readline()
+		if not line:
+			break
+		line_m = line_p.match(line)
+		if line_m is None:
+			await output.add(f"{f_origin}Unmatched: {decode_log_field(line)}")
+			continue
+		raw_time = line_m["time"]
+		if is_before_since and is_before_since(raw_time):
+			continue
+		remote_hostname = line_m[client_field]
+		if remote_hostname in exclude_hosts:
+			continue
+		request_first_line = get_field(line_m, "request_first_line")
+		if request_first_line is not None and (m := request_p.match(request_first_line)):
+			request = m.groupdict()
+		else:
+			request = None
+		geoip = lookup_geoip(remote_hostname)
+		time = parse_log_time(raw_time)
+
+		if oneline:
+			f_time = time.isoformat()
+			f_method = (request or {}).get("method", "<none>")
+			f_status = get_field(line_m, "final_status") or get_field(line_m, "status")
+			f_remote_host = decode_log_field(remote_hostname)
+			f_country = geoip["country"]["iso_code"] or "-"
+			f_state = geoip["state"]["iso_code"] or "-"
+			f_city = geoip["city"] or "-"
+			f_uri = (request or {}).get("uri", repr(request_first_line))
+			await output.add(f"""{f_origin}{f_time} {f_method:8} {f_status} {f_remote_host:15} {f_country:2} {f_state:2} {f_city:20} {f_uri}\n""", time)
+		else:
+			linedict = {name: decode_log_field(value) for name, value in line_m.groupdict().items()}
+			linedict["time"] = time
+			linedict["request"] = request
+			linedict["geoip"] = geoip
+			if origin is not None:
+				linedict["server_host"] = origin
+			await output.add(json.dumps(linedict, indent="\t", default=json_default) + "\n", time)
+	await output.flush()
+
+
+@contextlib.contextmanager
+def open_geoip_lookup(*, cache_size):
+	"""
+	Yields a function that returns format_geoip() of an address as bytes, and reports how well it was cached on exit.
+	"""
 	# https://github.com/maxmind/GeoIP2-python
 	# https://dev.maxmind.com/#GeoIP
 	with geoip2.database.Reader("/Users/vruyr/.bin/geoip2/GeoLite2-City_20200804/GeoLite2-City.mmdb") as geoip_reader_city:
 		with geoip2.database.Reader("/Users/vruyr/.bin/geoip2/GeoLite2-ASN_20200811/GeoLite2-ASN.mmdb") as geoip_reader_asn:
-			while True:
-				line = await input_stream.readline()
-				if not line:
-					break
-				line = line.decode("UTF-8") #TODO Don't assume UTF-8 encoding.
-				line_m = line_p.match(line)
-				if line_m is None:
-					await output_queue.put(f"Unmatched: {line}")
-					continue
-				linedict = line_m.groupdict()
-				linedict["time"] = datetime.datetime.strptime(linedict["time"], "%d/%b/%Y:%H:%M:%S %z")
-				if since and linedict["time"] < since:
-					continue
-				if m := request_p.match(linedict["request_first_line"]):
-					linedict["request"] = m.groupdict()
-				else:
-					linedict["request"] = None
-				remote_hostname = linedict["remote_hostname"]
-				if exclude_hosts and remote_hostname in exclude_hosts:
-					continue
+			# Most lines come from a few recurring clients. Addresses missing from the databases are cached too.
+			@functools.lru_cache(maxsize=cache_size)
+			def lookup_geoip(address):
+				address = address.decode("ASCII", errors="replace")
 				geoip_city = None
 				geoip_asn = None
 				try:
-					geoip_city = geoip_reader_city.city(remote_hostname)
+					geoip_city = geoip_reader_city.city(address)
 				except:
 					pass
 				try:
-					geoip_asn = geoip_reader_asn.asn(remote_hostname)
+					geoip_asn = geoip_reader_asn.asn(address)
 				except:
 					pass
-				linedict["geoip"] = format_geoip(geoip_city, geoip_asn)
-
-				if oneline:
-					f_time = linedict["time"].isoformat()
-					f_method = (linedict.get("request") or {}).get("method", "<none>")
-					f_status = linedict["final_status"]
-					f_remote_host = linedict["remote_hostname"]
-					f_country = linedict["geoip"]["country"]["iso_code"] or "-"
-					f_state = linedict["geoip"]["state"]["iso_code"] or "-"
-					f_city = linedict["geoip"]["city"] or "-"
-					f_uri = (linedict.get("request") or {}).get("uri", repr(linedict["request_first_line"]))
-					await output_queue.put(f"""{f_time} {f_method:8} {f_status} {f_remote_host:15} {f_country:2} {f_state:2} {f_city:20} {f_uri}\n""")
-				else:
-					await output_queue.put(json.dumps(linedict, indent="\t", default=json_default))
-					await output_queue.put("\n")
+				return format_geoip(geoip_city, geoip_asn)
+
+			try:
+				yield lookup_geoip
+			finally:
+				cache_info = lookup_geoip.cache_info()
+				lookups = cache_info.hits + cache_info.misses
+				hit_rate = f" ({cache_info.hits / lookups:.1%} hit rate)" if lookups else ""
+				print(
+					f"GeoIP cache: {cache_info.hits} hits, {cache_info.misses} misses{hit_rate},",
+					f"{cache_info.currsize} of {cache_info.maxsize} addresses",
+					file=sys.stderr,
+				)
+
+
+LOG_FORMATS = {
+	"common": '%h %l %u %t "%r" %>s %b',
+	"combined": '%h %l %u %t "%r" %>s %O "%{Referer}i" "%{User-Agent}i"',
+	"vhost_combined": '%v:%p %h %l %u %t "%r" %>s %O "%{Referer}i" "%{User-Agent}i"',
+}
+LOG_FORMAT_FIELDS = {
+	"a": "remote_address",
+	"A": "local_address",
+	"b": "response_size",
+	"B": "response_size",
+	"D": "duration_microseconds",
+	"f": "filename",
+	"h": "remote_hostname",
+	"H": "protocol",
+	"I": "bytes_received",
+	"k": "keepalive_requests",
+	"l": "remote_logname",
+	"L": "log_id",
+	"m": "method",
+	"O": "bytes_sent",
+	"p": "server_port",
+	"P": "process_id",
+	"q": "query_string",
+	"r": "request_first_line",
+	"R": "handler",
+	"s": "status",
+	"S": "bytes_transferred",
+	"t": "time",
+	"T": "duration_seconds",
+	"u": "remote_user",
+	"U": "url_path",
+	"v": "server_name",
+	"V": "server_name",
+	"X": "connection_status",
+}
+LOG_FORMAT_ARGUMENT_FIELD_PREFIXES = {"i": "", "o": "response_", "C": "cookie_", "e": "env_", "n": "note_"}
+LOG_FORMAT_HEADER_FIELDS = {"referer": "referrer", "user-agent": "useragent"}
+log_format_directive_pattern = re.compile(r"%(?P<modifiers>(?:[<>]|!?\d+(?:,\d+)*)*)(?:\{(?P<argument>[^}]*)\})?(?P<directive>[a-zA-Z%])")
+
+
+def compile_log_format(log_format):
+	"""
+	Compiles an Apache LogFormat string into a bytes regular expression with a named group per field. Fields between
+	double quotes may contain escaped quotes, others are anything up to the next space, except %t which is the
+	bracketed time.
+	"""
+	log_format = log_format.replace('\\"', '"')
+	pattern = [rb"^"]
+	names = set()
+	i = 0
+	for m in log_format_directive_pattern.finditer(log_format):
+		pattern.append(re.escape(log_format[i:m.start()].encode()))
+		i = m.end()
+		directive, argument = m["directive"], m["argument"]
+		if directive == "%":
+			pattern.append(rb"%")
+			continue
+		if argument is not None and directive in LOG_FORMAT_ARGUMENT_FIELD_PREFIXES:
+			name = LOG_FORMAT_HEADER_FIELDS.get(argument.lower()) if directive == "i" else None
+			name = name or LOG_FORMAT_ARGUMENT_FIELD_PREFIXES[directive] + re.sub(r"\W+", "_", argument.lower())
+		else:
+			# Custom %{format}t times aren't supported, they would need parsing with their format.
+			assert directive in LOG_FORMAT_FIELDS and not (directive == "t" and argument), ("Unsupported LogFormat directive", m[0])
+			name = LOG_FORMAT_FIELDS[directive]
+			if argument:
+				name += "_" + re.sub(r"\W+", "_", argument.lower())
+			if directive == "s" and ">" in m["modifiers"]:
+				name = "final_status"
+		while name in names:
+			name += "_"
+		names.add(name)
+		if directive == "t":
+			pattern.append(rb"\[(?P<time>[^]]+)\]")
+		elif log_format[m.start() - 1:m.start()] == '"' and log_format[m.end():m.end() + 1] == '"':
+			pattern.append(rb"(?P<%s>(?:[^\"\\]|\\.)*)" % name.encode())
+		else:
+			pattern.append(rb"(?P<%s>\S+)" % name.encode())
+	pattern.append(re.escape(log_format[i:].encode()))
+	pattern.append(rb"\s*$")
+	return re.compile(b"".join(pattern))
+
+
+def decode_log_field(value):
+	# Apache escapes non-printable bytes in most fields but not all of them.
+	return value.decode("UTF-8", errors="backslashreplace")
+
+
+LOG_TIME_MONTHS = {m.encode(): b"%02d" % i for i, m in enumerate(["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"], 1)}
+
+
+def log_time_key(raw):
+	"""
+	Rearranges a %t time such as 10/Oct/2000:13:55:36 -0700 into b"2000101013:55:36", which sorts the same as the
+	times of lines with the same UTC offset.
+	"""
+	return raw[7:11] + LOG_TIME_MONTHS.get(raw[3:6], b"00") + raw[0:2] + raw[12:20]
+
+
+@functools.cache
+def log_time_zone(offset):
+	return datetime.datetime.strptime(offset.decode(), "%z").tzinfo
+
+
+def parse_log_time(raw):
+	if len(raw) == 26 and raw[3:6] in LOG_TIME_MONTHS:
+		# Much faster than strptime, which is noticeable on every line of a large log.
+		return datetime.datetime(
+			int(raw[7:11]), int(LOG_TIME_MONTHS[raw[3:6]]), int(raw[0:2]),
+			int(raw[12:14]), int(raw[15:17]), int(raw[18:20]),
+			tzinfo=log_time_zone(raw[21:26]),
+		)
+	return datetime.datetime.strptime(raw.decode(), "%d/%b/%Y:%H:%M:%S %z")
+
+
+def make_log_time_filter(since):
+	"""
+	Returns a function that tells whether a raw %t time is before `since` without parsing it, by comparing log_time_key()
+	to `since` formatted the same way in the UTC offset of the line.
+	"""
+	since_keys = {}
+
+	def is_before_since(raw):
+		if len(raw) != 26:
+			return False
+		offset = raw[21:]
+		since_key = since_keys.get(offset)
+		if since_key is None:
+			since_local = since.astimezone(log_time_zone(offset))
+			if since_local.microsecond:
+				since_local = since_local.replace(microsecond=0) + datetime.timedelta(seconds=1)
+			since_key = since_keys[offset] = since_local.strftime("%Y%m%d%H:%M:%S").encode()
+		return log_time_key(raw) < since_key
+
+	return is_before_since
 
 
 def format_geoip(geoip_city, geoip_asn):
@@ -175,15 +426,352 @@ def format_geoip(geoip_city, geoip_asn):
 	}
 
 
-async def printer(*, queue, fo):
-	while True:
-		item = await queue.get()
-		if item is None:
-			break
-		if isinstance(item, (list, tuple)):
-			print(*item, file=fo, sep="", end="")
+# Apache logs a request when it's done but with the time it started, so the lines of slow requests are out of order.
+LOG_TIME_DISORDER = datetime.timedelta(minutes=1)
+LOG_FILE_POLL_INTERVAL = 0.5
+LOG_FILE_FINGERPRINT_SIZE = 1024
+
+
+class LogFileReader(object):
+	"""
+	Reads lines of a local log file through mmap, with the readline() coroutine of asyncio.StreamReader.
+
+	Starts at the first line skip_before() is false for, found with a binary search assuming the lines are in order, or
+	at the position recorded in the checkpoint file if it's further into the same file. With `follow`, waits for more
+	lines at the end of the file, reopening it if it's replaced by a rotation and rereading it if it's truncated. The
+	file is the same as long as it has the same inode and the same first line.
+
+	The checkpoint isn't written by the reader, a position from get_position() is passed to write_checkpoint() once
+	the lines read up to it have been printed.
+	"""
+
+	def __init__(self, path, *, follow=False, checkpoint_path=None, skip_before=None):
+		self.path = pathlib.Path(path)
+		self.follow = follow
+		self.checkpoint_path = pathlib.Path(checkpoint_path) if checkpoint_path else None
+		self.file = None
+		self.mm = b""
+		self.inode = None
+		self.fingerprint = None
+		self.offset = 0
+		self.checkpoint = None
+		self.open()
+		if skip_before is not None:
+			self.offset = self.find_first_line(skip_before)
+		checkpoint = self.read_checkpoint()
+		if (
+			checkpoint and checkpoint["inode"] == self.inode and checkpoint["offset"] <= len(self.mm) and
+			checkpoint["fingerprint"] == (self.fingerprint or b"").hex()
+		):
+			self.offset = max(self.offset, checkpoint["offset"])
+
+	def open(self):
+		self.file = self.path.open("rb")
+		self.inode = os.fstat(self.file.fileno()).st_ino
+		self.fingerprint = None
+		self.mm = b""
+		self.offset = 0
+		self.remap()
+
+	def remap(self):
+		"""
+		Maps the file again if its size has changed, returns whether it has been truncated.
+		"""
+		size = os.fstat(self.file.fileno()).st_size
+		if size == len(self.mm):
+			return False
+		truncated = size < len(self.mm)
+		if isinstance(self.mm, mmap.mmap):
+			self.mm.close()
+		self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+		# A file truncated by copytruncate can grow past its old size before it's checked again, but then it no longer
+		# starts with the same line.
+		fingerprint = self.get_fingerprint()
+		if self.fingerprint is not None and fingerprint != self.fingerprint:
+			truncated = True
+		if truncated or self.fingerprint is None:
+			self.fingerprint = fingerprint
+		return truncated
+
+	def get_fingerprint(self):
+		"""
+		Returns the first line of the file, at most LOG_FILE_FINGERPRINT_SIZE bytes of it, or None if it isn't complete.
+		"""
+		end = self.mm.find(b"\n", 0, LOG_FILE_FINGERPRINT_SIZE)
+		if end < 0:
+			return self.mm[:LOG_FILE_FINGERPRINT_SIZE] if len(self.mm) >= LOG_FILE_FINGERPRINT_SIZE else None
+		return self.mm[:end + 1]
+
+	def close(self):
+		if isinstance(self.mm, mmap.mmap):
+			self.mm.close()
+		self.file.close()
+
+	async def readline(self):
+		while True:
+			end = self.mm.find(b"\n", self.offset)
+			if end >= 0:
+				line = self.mm[self.offset:end + 1]
+				self.offset = end + 1
+				return line
+			size = len(self.mm)
+			if self.remap():
+				self.offset = 0
+				continue
+			if len(self.mm) > size:
+				continue
+			try:
+				rotated = os.stat(self.path).st_ino != self.inode
+			except FileNotFoundError:
+				rotated = False
+			if rotated:
+				# The rest of the old file, which won't be written to anymore even if it doesn't end with a newline.
+				line = self.mm[self.offset:]
+				self.offset += len(line)
+				if line:
+					return line
+				self.close()
+				self.open()
+				continue
+			if not self.follow:
+				# Without following, there is no next read to finish the last line, so it is returned as it is.
+				line = self.mm[self.offset:]
+				self.offset += len(line)
+				return line
+			# A line without a newline at the end is still being written and is left for the next read.
+			await asyncio.sleep(LOG_FILE_POLL_INTERVAL)
+
+	def find_first_line(self, skip_before):
+		"""
+		Returns the offset of the first line skip_before() is false for, assuming it's true for all the lines before it.
+		"""
+		mm = self.mm
+
+		def next_line_start(offset):
+			if offset == 0:
+				return 0
+			i = mm.find(b"\n", offset - 1)
+			return i + 1 if i >= 0 else len(mm)
+
+		# lo is always the start of a line and the result is in [lo, hi].
+		lo, hi = 0, len(mm)
+		while lo < hi:
+			start = next_line_start((lo + hi) // 2)
+			if start >= hi:
+				start = lo
+			end = next_line_start(start + 1)
+			if skip_before(mm[start:end]):
+				lo = end
+			else:
+				hi = start
+		return lo
+
+	def read_checkpoint(self):
+		if self.checkpoint_path is None:
+			return None
+		try:
+			with self.checkpoint_path.open("r") as fo:
+				return json.load(fo)
+		except FileNotFoundError:
+			return None
+
+	def get_position(self):
+		return (self.inode, self.fingerprint, self.offset)
+
+	def write_checkpoint(self, position):
+		if self.checkpoint_path is None or self.checkpoint == position:
+			return
+		self.checkpoint = position
+		inode, fingerprint, offset = position
+		temp_path = self.checkpoint_path.with_name(self.checkpoint_path.name + ".tmp")
+		with temp_path.open("w") as fo:
+			json.dump({"path": str(self.path), "inode": inode, "fingerprint": (fingerprint or b"").hex(), "offset": offset}, fo)
+		temp_path.replace(self.checkpoint_path)
+
+
+LOG_MERGER_MIN_TIME = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+LOG_MERGER_MAX_TIME = datetime.datetime.max.replace(tzinfo=datetime.timezone.utc)
+LOG_MERGER_TICK = 0.1
+LOG_MERGER_MAX_HELD = 65536
+
+
+class LogMerger(object):
+	"""
+	Merges the records of several sources into one output ordered by time, with a heap. The records of each source are
+	out of order too, so a record is written once every source has either sent a record at least `window` seconds
+	later or finished, or once it has been held back for `window` seconds, so a slow or disconnected source delays the
+	others at most that long. Records of a slow source that arrive after the others moved on are written as soon as
+	they arrive.
+
+	At most `max_held` records are held back, after that the sources that are ahead of the others wait for room.
+	"""
+
+	def __init__(self, output, *, window, max_held=LOG_MERGER_MAX_HELD):
+		self.output = output
+		self.window = window
+		self.max_held = max_held
+		self.heap = []
+		self.count = 0
+		# The latest (time, count) of the records that arrived in each LOG_MERGER_TICK, oldest first.
+		self.arrivals = collections.deque()
+		self.latest = {}
+		self.active = set()
+		# Writing awaits the output, records must not be reordered by two writers taking turns.
+		self.lock = asyncio.Condition()
+
+	def source(self, name):
+		self.active.add(name)
+		return LogMergerSource(self, name)
+
+	async def add(self, name, record, time):
+		async with self.lock:
+			await self.lock.wait_for(lambda: len(self.heap) < self.max_held or self.is_behind(name))
+			if time is None:
+				# Records without a time, such as unmatched lines, go with the previous record of the source.
+				time = self.latest.get(name, LOG_MERGER_MIN_TIME)
+			else:
+				self.latest[name] = max(time, self.latest.get(name, time))
+			key = (time, self.count)
+			heapq.heappush(self.heap, (*key, record))
+			self.count += 1
+			now = asyncio.get_running_loop().time()
+			if self.arrivals and now - self.arrivals[-1][0] < LOG_MERGER_TICK:
+				self.arrivals[-1] = (self.arrivals[-1][0], max(self.arrivals[-1][1], key))
+			else:
+				self.arrivals.append((now, key))
+			await self.write_ready()
+
+	async def finish(self, name):
+		async with self.lock:
+			self.active.discard(name)
+			await self.write_ready()
+
+	def is_behind(self, name):
+		"""
+		Whether no other source is waited for to catch up with `name`, which must be able to add records to move on.
+		"""
+		latest = self.latest.get(name)
+		return latest is None or all(self.latest.get(n, LOG_MERGER_MIN_TIME) >= latest for n in self.active)
+
+	async def write_ready(self):
+		# Called with the lock held.
+		now = asyncio.get_running_loop().time()
+		waiting_for = [self.latest.get(name) for name in self.active]
+		if not self.active:
+			watermark = (LOG_MERGER_MAX_TIME, math.inf)
+		elif None in waiting_for:
+			watermark = None
 		else:
-			print(item, file=fo, sep="", end="")
+			watermark = (min(waiting_for) - datetime.timedelta(seconds=self.window), math.inf)
+		# The records that have been held back for long enough are written along with all the ones before them.
+		while self.arrivals and now - self.arrivals[0][0] >= self.window:
+			arrived_at, key = self.arrivals.popleft()
+			watermark = max(watermark or key, key)
+		while self.heap and watermark is not None and self.heap[0][:2] <= watermark:
+			time, count, record = heapq.heappop(self.heap)
+			await self.output.add(record, time)
+		if not self.heap:
+			self.arrivals.clear()
+		self.lock.notify_all()
+		if not self.active:
+			await self.output.flush()
+
+	async def run(self):
+		"""
+		Writes the records that have been held back for too long, until all sources have finished.
+		"""
+		while self.active:
+			await asyncio.sleep(LOG_MERGER_TICK)
+			async with self.lock:
+				await self.write_ready()
+
+
+class LogMergerSource(object):
+	"""
+	The output of one source of a LogMerger.
+	"""
+
+	def __init__(self, merger, name):
+		self.merger = merger
+		self.name = name
+
+	async def add(self, record, time=None):
+		await self.merger.add(self.name, record, time)
+
+	async def flush(self):
+		await self.merger.finish(self.name)
+
+
+OUTPUT_QUEUE_SIZE = 16
+OUTPUT_BATCH_SIZE = 256
+OUTPUT_FLUSH_DELAY = 0.1
+
+
+class OutputBatcher(object):
+	"""
+	Collects formatted records into batches for the printer. The queue is bounded, so a backfill waits for the printer
+	instead of piling up in memory, and a partial batch is handed over `flush_delay` seconds after its first record, so
+	tailing a live log isn't held back waiting for a batch to fill. Every batch goes along with the get_checkpoint()
+	position of the input after its last record.
+	"""
+
+	def __init__(self, queue, *, batch_size=OUTPUT_BATCH_SIZE, flush_delay=OUTPUT_FLUSH_DELAY, get_checkpoint=None):
+		self.queue = queue
+		self.get_checkpoint = get_checkpoint or (lambda: None)
+		self.batch_size = batch_size
+		self.flush_delay = flush_delay
+		self.batch = []
+		self.timer = None
+
+	async def add(self, record, time=None):
+		# The time is for LogMerger, records are written in the order they are added.
+		self.batch.append(record)
+		if len(self.batch) >= self.batch_size:
+			await self.flush()
+		elif self.timer is None:
+			self.timer = asyncio.get_running_loop().call_later(self.flush_delay, self.flush_partial)
+
+	async def flush(self):
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+		if self.batch:
+			batch, self.batch = "".join(self.batch), []
+			await self.queue.put((batch, self.get_checkpoint()))
+
+	def flush_partial(self):
+		# A timer callback can't wait for room in the queue, but if there is none the printer is busy anyway.
+		self.timer = None
+		if not self.batch:
+			return
+		if self.queue.full():
+			self.timer = asyncio.get_running_loop().call_later(self.flush_delay, self.flush_partial)
+			return
+		batch, self.batch = "".join(self.batch), []
+		self.queue.put_nowait((batch, self.get_checkpoint()))
+
+
+async def printer(*, queue, fo, write_checkpoint=None):
+	"""
+	Writes the batches from the queue until it gets None. The checkpoint of the last written batch is passed to
+	write_checkpoint() whenever the output is flushed, including when it's interrupted.
+	"""
+	checkpoint = None
+	try:
+		while True:
+			item = await queue.get()
+			if item is None:
+				break
+			batch, checkpoint = item
+			fo.write(batch)
+			if queue.empty():
+				fo.flush()
+				if write_checkpoint and checkpoint is not None:
+					write_checkpoint(checkpoint)
+	finally:
+		fo.flush()
+		if write_checkpoint and checkpoint is not None:
+			write_checkpoint(checkpoint)
 
 
 def smain(argv=None):
@@ -4,24 +4,30 @@
 # /// script
 # requires-python = ">=3.14,<4"
 # dependencies = [
+#   "IMAPClient >=2.2.0,<3.0",
 # ]
 # ///
 
-import sys, locale, argparse, pathlib, collections, json, subprocess
+import sys, locale, argparse, pathlib, collections, json, importlib.util, concurrent.futures, time, urllib.parse
 
 
 CONFIG_DIR = pathlib.Path.home() / ".config" / pathlib.Path(__file__).stem
+CACHE_PATH = pathlib.Path.home() / ".cache" / pathlib.Path(__file__).stem / "mailboxes.json"
 
 
 def main(
 	*,
 	# Example Options
-	show_all_mailboxes: bool
+	show_all_mailboxes: bool,
+	# Cache Options
+	cache_ttl: float,
+	refresh: bool,
 ) -> None:
 	locale.setlocale(locale.LC_ALL, "")
 
+	accounts = list_accounts(cache_ttl=0 if refresh else cache_ttl)
 	if show_all_mailboxes:
-		for label, entries in list_accounts():
+		for label, entries in accounts:
 			print(label)
 			for entry in sorted(entries, key=mailbox_name_sort_order_key):
 				print("\t", "/".join(entry["path"]), sep="")
@@ -29,12 +35,12 @@ def main(
 	else:
 		folders = collections.defaultdict(list)
 		ignored_paths = set(tuple(path) for path in read_config("ignore"))
-		for label, entries in list_accounts():
+		for label, entries in accounts:
 			for entry in entries:
-				path = entry["path"]
-				if tuple(path) in ignored_paths:
+				if tuple(entry["path"]) in ignored_paths:
 					continue
-				path.insert(0, label)
+				# Labels of the same account share the cached entries.
+				path = [label, *entry["path"]]
 				for p in path:
 					assert "/" not in p
 				folders[path[-1]].append("/".join(path))
@@ -68,27 +74,76 @@ def mailbox_name_sort_order_key(entry):
 	return order
 
 
-def list_accounts():
-	for label, url in read_config("accounts"):
-		p = subprocess.run(
-			["imap.py", "-a", url, "--json"],
-			stdout=subprocess.PIPE,
-			stderr=subprocess.PIPE,
-			shell=False
-		)
-		assert p.returncode == 0, p
-		assert not p.stderr
-		try:
-			out = p.stdout.decode()
-		except:
-			print(p.stdout)
-			raise
-		try:
-			out = json.loads(out)
-		except:
-			print(out)
-			raise
-		yield (label, out)
+def list_accounts(*, cache_ttl):
+	"""
+	Returns [(label, mailboxes)] of the configured accounts, listing the ones not cached within `cache_ttl` seconds
+	concurrently, each on its own connection.
+	"""
+	accounts = [(label, get_cache_key(url), url) for label, url in read_config("accounts")]
+	cache = read_cache()
+	now = time.time()
+	stale = {key: url for label, key, url in accounts if now - cache.get(key, {}).get("time", 0) >= cache_ttl}
+	if stale:
+		imap = load_imap()
+		imap.verbosity = 0
+		no_overrides = argparse.Namespace(server=None, username=None, password=None, path=None)
+		# Parsed one by one, and only when they are going to be listed, because a missing password is prompted for.
+		stale = {key: imap.parse_account(no_overrides, url) for key, url in stale.items()}
+		with concurrent.futures.ThreadPoolExecutor(max_workers=len(stale)) as executor:
+			futures = {key: executor.submit(list_mailboxes, imap, account) for key, account in stale.items()}
+		# The accounts that were listed are cached even if another one failed.
+		error = None
+		for key, future in futures.items():
+			try:
+				cache[key] = {"time": now, "mailboxes": future.result()}
+			except Exception as e:
+				error = error or e
+		write_cache(cache)
+		if error is not None:
+			raise error
+	return [(label, cache[key]["mailboxes"]) for label, key, url in accounts]
+
+
+def get_cache_key(url):
+	"""
+	The account URL without the password, if it has one.
+	"""
+	url = urllib.parse.urlsplit(url)
+	userinfo, at, hostport = url.netloc.rpartition("@")
+	return url._replace(netloc=userinfo.partition(":")[0] + at + hostport).geturl()
+
+
+def list_mailboxes(imap, account):
+	conn = imap.connect(account)
+	assert conn is not None, account.key
+	try:
+		return imap.get_mailboxes(conn)
+	finally:
+		conn.logout()
+
+
+def load_imap():
+	path = pathlib.Path(__file__).with_name("imap.py")
+	spec = importlib.util.spec_from_file_location("imap", path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+
+def read_cache():
+	try:
+		with CACHE_PATH.open("r") as fo:
+			return json.load(fo)
+	except FileNotFoundError:
+		return {}
+
+
+def write_cache(cache):
+	CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+	temp_path = CACHE_PATH.with_suffix(".tmp")
+	with temp_path.open("w") as fo:
+		json.dump(cache, fo, indent="\t")
+	temp_path.replace(CACHE_PATH)
 
 
 def read_config(name):
@@ -122,6 +177,18 @@ def parse_args(*, args, prog):
 		help="instead of finding mailboxes with same name, simply list all mailboxes in all accounts" + the_default
 	)
 
+	options_cache = parser.add_argument_group("Cache Options")
+	options_cache.add_argument(
+		"--cache-ttl",
+		action="store", dest="cache_ttl", metavar="SECONDS", type=float, default=3600, required=False,
+		help=f"reuse the mailboxes of an account listed within this many seconds, cached in {CACHE_PATH}" + the_default
+	)
+	options_cache.add_argument(
+		"--refresh",
+		action="store_true", dest="refresh", default=False, required=False,
+		help="list the mailboxes of all accounts even if they are cached" + the_default
+	)
+
 	opts = parser.parse_args(args)
 	return vars(opts)
 
@@ -0,0 +1,794 @@
+#!/usr/bin/env -S uv --quiet run --no-project --script --
+# https://peps.python.org/pep-0723/
+# https://github.com/astral-sh/uv
+# /// script
+# requires-python = ">=3.14,<4"
+# dependencies = [
+# ]
+# ///
+
+"""
+A stand-in IMAP4rev1 server for testing and benchmarking imap.py without a real mail account. Serves mailboxes loaded
+from Maildir directories or generated on the fly, over TLS with a self-signed certificate, with optional latency
+injected before every response.
+
+Supports LOGIN, AUTHENTICATE PLAIN, NAMESPACE, LIST (with RETURN STATUS), SELECT, EXAMINE, SEARCH, FETCH, STATUS, IDLE,
+NOOP and their UID variants, CONDSTORE's MODSEQ and CHANGEDSINCE, and nothing else that imap.py uses. STORE, APPEND,
+EXPUNGE and CLOSE are there for changing mailboxes from another connection while imap.py is looking at them, the way
+other clients of a real account do, e.g. to test flag changes picked up with CHANGEDSINCE or messages arriving during
+--watch. New messages also arrive every --deliver-every seconds. Nothing is written back to Maildir directories.
+"""
+
+import sys, argparse, asyncio, ssl, pathlib, tempfile, subprocess, random, email, email.utils, email.policy, re, time
+import datetime, fnmatch, base64, collections, email.header
+
+
+CAPABILITIES = "IMAP4rev1 NAMESPACE IDLE ENABLE CONDSTORE LIST-STATUS STATUS=SIZE AUTH=PLAIN"
+
+
+async def main(*, host, port, username, password, maildirs, generate, latency, deliver_every, seed, verbose):
+	store = MailStore()
+	for path in maildirs:
+		store.load_maildir(path)
+	for spec in generate:
+		name, count = spec.rsplit("=", 1) if "=" in spec else ("INBOX", spec)
+		store.generate(name, int(count), seed=seed)
+	if not store.mailboxes:
+		store.generate("INBOX", 100, seed=seed)
+
+	server = ImapServer(store=store, username=username, password=password, latency=latency, verbose=verbose)
+	tcp_server = await server.start(host=host, port=port)
+	address = tcp_server.sockets[0].getsockname()
+	print(f"imaps://{username}:{password}@{address[0]}:{address[1]}/?ssl=promiscuous", flush=True)
+	async with tcp_server:
+		if deliver_every:
+			asyncio.create_task(store.deliver_periodically(deliver_every, seed=seed))
+		await tcp_server.serve_forever()
+
+
+class Message(object):
+	__slots__ = ("uid", "flags", "internaldate", "data", "modseq", "_parsed")
+
+	def __init__(self, *, uid, flags, internaldate, data, modseq):
+		self.uid = uid
+		self.flags = set(flags)
+		self.internaldate = internaldate
+		self.data = data
+		self.modseq = modseq
+		self._parsed = None
+
+	@property
+	def parsed(self):
+		if self._parsed is None:
+			self._parsed = email.message_from_bytes(self.data, policy=email.policy.compat32)
+		return self._parsed
+
+	@property
+	def header(self):
+		i = self.data.find(b"\r\n\r\n")
+		return self.data[:i + 4] if i >= 0 else self.data
+
+	@property
+	def text(self):
+		i = self.data.find(b"\r\n\r\n")
+		return self.data[i + 4:] if i >= 0 else b""
+
+
+class Mailbox(object):
+	def __init__(self, name):
+		self.name = name
+		self.uidvalidity = random.randint(1, 2**31)
+		self.uidnext = 1
+		self.highestmodseq = 1
+		self.messages = []
+		self.listeners = set()
+
+	def append(self, data, *, flags=(), internaldate=None):
+		self.highestmodseq += 1
+		message = Message(
+			uid=self.uidnext,
+			flags=flags,
+			internaldate=internaldate or datetime.datetime.now(datetime.timezone.utc),
+			data=data.replace(b"\r\n", b"\n").replace(b"\n", b"\r\n"),
+			modseq=self.highestmodseq,
+		)
+		self.uidnext += 1
+		self.messages.append(message)
+		for listener in self.listeners:
+			listener.set()
+		return message
+
+
+class MailStore(object):
+	def __init__(self):
+		self.mailboxes = {}
+
+	def get(self, name):
+		if name.upper() == "INBOX":
+			name = "INBOX"
+		return self.mailboxes.get(name)
+
+	def create(self, name):
+		if name not in self.mailboxes:
+			self.mailboxes[name] = Mailbox(name)
+		return self.mailboxes[name]
+
+	def load_maildir(self, path):
+		"""
+		Loads a Maildir++ directory, subfolders such as .Sent become mailboxes next to INBOX.
+		"""
+		path = pathlib.Path(path)
+		folders = [("INBOX", path)]
+		folders.extend((p.name[1:].replace(".", "/"), p) for p in sorted(path.glob(".*")) if p.is_dir())
+		for name, folder in folders:
+			mailbox = self.create(name)
+			files = [f for sub in ("cur", "new") for f in sorted(folder.joinpath(sub).glob("*")) if f.is_file()]
+			for f in sorted(files, key=lambda f: f.stat().st_mtime):
+				info = f.name.rsplit(":2,", 1)[1] if ":2," in f.name else ""
+				flags = [MAILDIR_FLAGS[c] for c in info if c in MAILDIR_FLAGS]
+				internaldate = datetime.datetime.fromtimestamp(f.stat().st_mtime, datetime.timezone.utc)
+				mailbox.append(f.read_bytes(), flags=flags, internaldate=internaldate)
+
+	def generate(self, name, count, *, seed=0):
+		rng = random.Random(f"{seed}/{name}")
+		mailbox = self.create(name)
+		now = datetime.datetime.now(datetime.timezone.utc)
+		for i in range(count):
+			date = now - datetime.timedelta(seconds=rng.randint(0, 86400 * 365 * 3))
+			flags = [f for f, p in (("\\Seen", 0.7), ("\\Flagged", 0.05), ("\\Answered", 0.2)) if rng.random() < p]
+			mailbox.append(generate_message(rng, date=date), flags=flags, internaldate=date)
+
+	async def deliver_periodically(self, interval, *, seed=0):
+		rng = random.Random(seed)
+		while True:
+			await asyncio.sleep(interval)
+			mailbox = self.get("INBOX") or self.create("INBOX")
+			mailbox.append(generate_message(rng, date=datetime.datetime.now(datetime.timezone.utc)))
+
+
+MAILDIR_FLAGS = {"S": "\\Seen", "F": "\\Flagged", "R": "\\Answered", "T": "\\Deleted", "D": "\\Draft"}
+NAMES = ["Ada Lovelace", "Alan Turing", "Grace Hopper", "Edsger Dijkstra", "Barbara Liskov", "Ken Thompson"]
+WORDS = "quarterly report invoice meeting agenda release notes build failed lunch review draft update".split()
+
+
+def generate_message(rng, *, date):
+	sender, recipient = rng.sample(NAMES, 2)
+	address = lambda name: "{}@example.com".format(name.split()[0].lower())
+	subject = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))).capitalize()
+	body = "\r\n".join(" ".join(rng.choice(WORDS) for _ in range(12)) for _ in range(rng.randint(3, 60)))
+	return (
+		f"Date: {email.utils.format_datetime(date)}\r\n"
+		f"From: {sender} <{address(sender)}>\r\n"
+		f"To: {recipient} <{address(recipient)}>\r\n"
+		f"Subject: {subject}\r\n"
+		f"Message-ID: <{rng.getrandbits(64):016x}@example.com>\r\n"
+		f"MIME-Version: 1.0\r\n"
+		f"Content-Type: text/plain; charset=utf-8\r\n"
+		f"\r\n"
+		f"{body}\r\n"
+	).encode()
+
+
+class ImapError(Exception):
+	pass
+
+
+class ImapServer(object):
+	def __init__(self, *, store, username, password, latency=0.0, verbose=False):
+		self.store = store
+		self.verbose = verbose
+		self.username = username
+		self.password = password
+		self.latency = latency
+		self.command_count = 0
+		self.command_counts = collections.Counter()
+
+	async def start(self, *, host="127.0.0.1", port=0):
+		return await asyncio.start_server(self.handle_connection, host=host, port=port, ssl=create_ssl_context())
+
+	async def handle_connection(self, reader, writer):
+		session = ImapSession(server=self, reader=reader, writer=writer)
+		try:
+			await session.run()
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		finally:
+			writer.close()
+
+
+class ImapSession(object):
+	def __init__(self, *, server, reader, writer):
+		self.server = server
+		self.store = server.store
+		self.reader = reader
+		self.writer = writer
+		self.is_authenticated = False
+		self.mailbox = None
+		self.readonly = True
+		self.known_count = 0
+
+	def send(self, line):
+		if isinstance(line, str):
+			line = line.encode()
+		self.writer.write(line + b"\r\n")
+
+	async def read_command(self):
+		"""
+		Reads a command line, with literals inlined as (bytes,) tuples of tokens.
+		"""
+		parts = []
+		while True:
+			line = await self.reader.readline()
+			if not line:
+				return None
+			line = line.rstrip(b"\r\n")
+			m = re.search(rb"\{(\d+)(\+?)\}$", line)
+			if not m:
+				parts.append((line, None))
+				return parts
+			if not m.group(2):
+				self.send("+ Ready for literal data")
+				await self.writer.drain()
+			literal = await self.reader.readexactly(int(m.group(1)))
+			parts.append((line[:m.start()], literal))
+
+	async def run(self):
+		self.send(f"* OK [CAPABILITY {CAPABILITIES}] imap-test-server ready")
+		await self.writer.drain()
+		while True:
+			parts = await self.read_command()
+			if parts is None:
+				return
+			tokens = tokenize_command(parts)
+			if len(tokens) < 2:
+				self.send(b"* BAD Missing command")
+				continue
+			tag, command, args = tokens[0], tokens[1].upper(), tokens[2:]
+			self.server.command_count += 1
+			if self.server.verbose:
+				print(" ".join(str(t) for t in tokens[1:])[:200], file=sys.stderr, flush=True)
+			self.server.command_counts[command] += 1
+			if self.server.latency:
+				await asyncio.sleep(self.server.latency)
+			try:
+				if command == "UID":
+					subcommand = args.pop(0).upper()
+					status = await getattr(self, "do_" + subcommand)(args, use_uid=True)
+				else:
+					handler = getattr(self, "do_" + command, None)
+					if handler is None:
+						raise ImapError(f"Unknown command {command}")
+					if command in ("LOGOUT",):
+						await handler(args)
+						self.send(f"{tag} OK LOGOUT completed")
+						await self.writer.drain()
+						return
+					status = await handler(args)
+				self.send(f"{tag} OK {status or command + ' completed'}")
+			except ImapError as e:
+				self.send(f"{tag} NO {e}")
+			except (IndexError, ValueError, KeyError) as e:
+				self.send(f"{tag} BAD {type(e).__name__}: {e}")
+			await self.writer.drain()
+
+	def require_auth(self):
+		if not self.is_authenticated:
+			raise ImapError("Not authenticated")
+
+	def require_selected(self):
+		self.require_auth()
+		if self.mailbox is None:
+			raise ImapError("No mailbox selected")
+
+	async def do_CAPABILITY(self, args):
+		self.send(f"* CAPABILITY {CAPABILITIES}")
+
+	async def do_NOOP(self, args):
+		self.send_new_messages()
+
+	async def do_CHECK(self, args):
+		self.send_new_messages()
+
+	async def do_LOGOUT(self, args):
+		self.send("* BYE imap-test-server logging out")
+
+	async def do_LOGIN(self, args):
+		username, password = args
+		if (username, password) != (self.server.username, self.server.password):
+			raise ImapError("[AUTHENTICATIONFAILED] Invalid credentials")
+		self.is_authenticated = True
+		return f"[CAPABILITY {CAPABILITIES}] LOGIN completed"
+
+	async def do_AUTHENTICATE(self, args):
+		if args[0].upper() != "PLAIN":
+			raise ImapError("Unsupported authentication mechanism")
+		if len(args) > 1:
+			response = args[1]
+		else:
+			self.send("+ ")
+			await self.writer.drain()
+			response = (await self.reader.readline()).strip().decode()
+		_, username, password = base64.b64decode(response).decode().split("\0")
+		return await self.do_LOGIN([username, password])
+
+	async def do_NAMESPACE(self, args):
+		self.require_auth()
+		self.send('* NAMESPACE (("" "/")) NIL NIL')
+
+	async def do_LIST(self, args):
+		self.require_auth()
+		reference, pattern = args[0], args[1]
+		return_status = None
+		if len(args) > 2 and str(args[2]).upper() == "RETURN":
+			options = args[3]
+			for i, option in enumerate(options):
+				if str(option).upper() == "STATUS":
+					return_status = options[i + 1]
+		if pattern == "":
+			self.send('* LIST (\\Noselect) "/" ""')
+			return
+		pattern = reference + pattern
+		names = sorted(self.store.mailboxes, key=lambda n: (n != "INBOX", n))
+		for name in names:
+			if not fnmatch.fnmatchcase(name, pattern.replace("%", "*")):
+				continue
+			if "%" in pattern and name.count("/") != pattern.count("/"):
+				continue
+			children = any(n.startswith(name + "/") for n in names)
+			self.send('* LIST ({}) "/" {}'.format("\\HasChildren" if children else "\\HasNoChildren", quote(name)))
+			if return_status:
+				self.send_status(self.store.get(name), return_status)
+
+	async def do_STATUS(self, args):
+		self.require_auth()
+		mailbox = self.store.get(args[0])
+		if mailbox is None:
+			raise ImapError("No such mailbox")
+		self.send_status(mailbox, args[1])
+
+	def send_status(self, mailbox, items):
+		values = {
+			"MESSAGES": lambda: len(mailbox.messages),
+			"RECENT": lambda: 0,
+			"UNSEEN": lambda: sum(1 for m in mailbox.messages if "\\Seen" not in m.flags),
+			"UIDNEXT": lambda: mailbox.uidnext,
+			"UIDVALIDITY": lambda: mailbox.uidvalidity,
+			"SIZE": lambda: sum(len(m.data) for m in mailbox.messages),
+			"HIGHESTMODSEQ": lambda: mailbox.highestmodseq,
+		}
+		self.send("* STATUS {} ({})".format(
+			quote(mailbox.name),
+			" ".join(f"{item.upper()} {values[item.upper()]()}" for item in items)
+		))
+
+	async def do_SELECT(self, args, readonly=False):
+		self.require_auth()
+		mailbox = self.store.get(args[0])
+		if mailbox is None:
+			self.mailbox = None
+			raise ImapError("No such mailbox")
+		if self.mailbox is not None:
+			self.mailbox.listeners.discard(self)
+		self.mailbox = mailbox
+		self.readonly = readonly
+		self.known_count = len(mailbox.messages)
+		self.send("* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)")
+		self.send(f"* {len(mailbox.messages)} EXISTS")
+		self.send("* 0 RECENT")
+		self.send(f"* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid")
+		self.send(f"* OK [UIDNEXT {mailbox.uidnext}] Predicted next UID")
+		self.send(f"* OK [HIGHESTMODSEQ {mailbox.highestmodseq}] Highest")
+		return "[READ-ONLY] EXAMINE completed" if readonly else "[READ-WRITE] SELECT completed"
+
+	async def do_EXAMINE(self, args):
+		return await self.do_SELECT(args, readonly=True)
+
+	async def do_ENABLE(self, args):
+		self.require_auth()
+		enabled = [a.upper() for a in args if a.upper() in ("CONDSTORE",)]
+		self.send("* ENABLED" + "".join(f" {a}" for a in enabled))
+
+	async def do_STORE(self, args, use_uid=False):
+		self.require_selected()
+		if self.readonly:
+			raise ImapError("Mailbox is read-only")
+		sequence_set, action, flags = args[0], args[1].upper(), args[2]
+		flags = set(flags if isinstance(flags, list) else [flags])
+		messages = self.mailbox.messages
+		if use_uid:
+			wanted = parse_sequence_set(sequence_set, largest=self.mailbox.uidnext - 1)
+		else:
+			wanted = {messages[n - 1].uid for n in parse_sequence_set(sequence_set, largest=len(messages))}
+		for n, m in enumerate(messages, 1):
+			if m.uid not in wanted:
+				continue
+			if action.startswith("+"):
+				m.flags |= flags
+			elif action.startswith("-"):
+				m.flags -= flags
+			else:
+				m.flags = set(flags)
+			self.mailbox.highestmodseq += 1
+			m.modseq = self.mailbox.highestmodseq
+			if not action.endswith(".SILENT"):
+				self.send("* {} FETCH (UID {} FLAGS ({}))".format(n, m.uid, " ".join(sorted(m.flags))))
+
+	async def do_APPEND(self, args):
+		self.require_auth()
+		mailbox = self.store.get(args[0])
+		if mailbox is None:
+			raise ImapError("[TRYCREATE] No such mailbox")
+		flags = args[1] if isinstance(args[1], list) else []
+		mailbox.append(args[-1].encode("utf-8", errors="surrogateescape"), flags=flags)
+		self.send_new_messages()
+
+	async def do_EXPUNGE(self, args):
+		self.require_selected()
+		if self.readonly:
+			raise ImapError("Mailbox is read-only")
+		messages = self.mailbox.messages
+		for n in range(len(messages), 0, -1):
+			if "\\Deleted" in messages[n - 1].flags:
+				del messages[n - 1]
+				self.send(f"* {n} EXPUNGE")
+		self.mailbox.highestmodseq += 1
+		self.known_count = len(messages)
+
+	async def do_CLOSE(self, args):
+		self.require_selected()
+		self.mailbox = None
+
+	def send_new_messages(self):
+		if self.mailbox is not None and len(self.mailbox.messages) != self.known_count:
+			self.known_count = len(self.mailbox.messages)
+			self.send(f"* {self.known_count} EXISTS")
+
+	async def do_IDLE(self, args):
+		self.require_selected()
+		self.send("+ idling")
+		await self.writer.drain()
+		event = asyncio.Event()
+		self.mailbox.listeners.add(event)
+		try:
+			done = asyncio.ensure_future(self.reader.readline())
+			while True:
+				self.send_new_messages()
+				await self.writer.drain()
+				waiter = asyncio.ensure_future(event.wait())
+				finished, _ = await asyncio.wait([done, waiter], return_when=asyncio.FIRST_COMPLETED)
+				if done in finished:
+					waiter.cancel()
+					line = done.result()
+					if line.strip().upper() != b"DONE":
+						raise ImapError("Expected DONE")
+					return "IDLE terminated"
+				event.clear()
+		finally:
+			self.mailbox.listeners.discard(event)
+
+	async def do_SEARCH(self, args, use_uid=False):
+		self.require_selected()
+		if args and str(args[0]).upper() == "CHARSET":
+			args = args[2:]
+		messages = self.mailbox.messages
+		criteria = parse_search_criteria(list(args), messages=messages)
+		result = [(m.uid if use_uid else i + 1) for i, m in enumerate(messages) if criteria(i + 1, m)]
+		self.send("* SEARCH" + "".join(f" {n}" for n in result))
+
+	async def do_FETCH(self, args, use_uid=False):
+		self.require_selected()
+		messages = self.mailbox.messages
+		sequence_set, items = args[0], args[1]
+		changed_since = None
+		if len(args) > 2:
+			modifiers = args[2]
+			if str(modifiers[0]).upper() == "CHANGEDSINCE":
+				changed_since = int(modifiers[1])
+		if not isinstance(items, list):
+			items = FETCH_MACROS.get(items.upper(), [items])
+		items = list(items)
+		if use_uid and not any(str(i).upper() == "UID" for i in items):
+			items.insert(0, "UID")
+		if changed_since is not None and not any(str(i).upper() == "MODSEQ" for i in items):
+			items.append("MODSEQ")
+		if use_uid:
+			uids = parse_sequence_set(sequence_set, largest=self.mailbox.uidnext - 1)
+			selected = [(i + 1, m) for i, m in enumerate(messages) if m.uid in uids]
+		else:
+			numbers = parse_sequence_set(sequence_set, largest=len(messages))
+			selected = [(n, messages[n - 1]) for n in sorted(numbers) if 1 <= n <= len(messages)]
+		for n, m in selected:
+			if changed_since is not None and m.modseq <= changed_since:
+				continue
+			self.writer.write(f"* {n} FETCH (".encode() + b" ".join(fetch_item(m, item) for item in items) + b")\r\n")
+			if self.writer.transport.get_write_buffer_size() > 1 << 20:
+				await self.writer.drain()
+
+
+FETCH_MACROS = {
+	"ALL": ["FLAGS", "INTERNALDATE", "RFC822.SIZE", "ENVELOPE"],
+	"FAST": ["FLAGS", "INTERNALDATE", "RFC822.SIZE"],
+	"FULL": ["FLAGS", "INTERNALDATE", "RFC822.SIZE", "ENVELOPE", "BODY"],
+}
+
+
+def fetch_item(m, item):
+	name = item.upper()
+	if name == "UID":
+		return f"UID {m.uid}".encode()
+	if name == "FLAGS":
+		return "FLAGS ({})".format(" ".join(sorted(m.flags))).encode()
+	if name == "INTERNALDATE":
+		return 'INTERNALDATE "{}"'.format(m.internaldate.strftime("%d-%b-%Y %H:%M:%S %z")).encode()
+	if name == "RFC822.SIZE":
+		return f"RFC822.SIZE {len(m.data)}".encode()
+	if name == "MODSEQ":
+		return f"MODSEQ ({m.modseq})".encode()
+	if name == "ENVELOPE":
+		return b"ENVELOPE " + format_envelope(m)
+	if name in ("BODY", "BODYSTRUCTURE"):
+		lines = m.text.count(b"\n")
+		return name.encode() + b' ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" ' + f"{len(m.text)} {lines})".encode()
+	if name in ("RFC822", "RFC822.HEADER", "RFC822.TEXT"):
+		data = {"RFC822": m.data, "RFC822.HEADER": m.header, "RFC822.TEXT": m.text}[name]
+		return name.encode() + b" " + literal(data)
+	mo = re.fullmatch(r"BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?", name)
+	if mo:
+		section, offset, length = mo.groups()
+		if section == "":
+			data = m.data
+		elif section == "HEADER":
+			data = m.header
+		elif section == "TEXT":
+			data = m.text
+		elif section.startswith("HEADER.FIELDS"):
+			fields = set(re.findall(r"[^\s()]+", section[len("HEADER.FIELDS"):]))
+			fields = {f.upper() for f in fields}
+			lines = re.split(rb"\r\n(?![ \t])", m.header.rstrip(b"\r\n"))
+			data = b"".join(l + b"\r\n" for l in lines if l.split(b":", 1)[0].decode().upper() in fields) + b"\r\n"
+		else:
+			raise ValueError(f"Unsupported section {section}")
+		label = f"BODY[{section}]"
+		if offset is not None:
+			offset, length = int(offset), int(length)
+			data = data[offset:offset + length]
+			label += f"<{offset}>"
+		return label.encode() + b" " + literal(data)
+	raise ValueError(f"Unsupported fetch item {item}")
+
+
+def format_envelope(m):
+	msg = m.parsed
+
+	def nstring(s):
+		return quote(s) if s is not None else "NIL"
+
+	def addresses(header):
+		values = msg.get_all(header)
+		if not values:
+			return "NIL"
+		result = []
+		m = re.fullmatch(r"\s*([^:<>\"]+):\s*;\s*", " ".join(values))
+		if m:
+			# An empty group such as "undisclosed-recipients:;".
+			return "((NIL NIL {} NIL)(NIL NIL NIL NIL))".format(nstring(m.group(1).strip()))
+		for name, address in email.utils.getaddresses(values):
+			mailbox, _, host = address.partition("@")
+			result.append("({} NIL {} {})".format(nstring(name or None), nstring(mailbox), nstring(host or None)))
+		return "(" + "".join(result) + ")"
+
+	from_ = addresses("From")
+	return "({} {} {} {} {} {} {} {} {} {})".format(
+		nstring(msg["Date"]),
+		nstring(msg["Subject"]),
+		from_,
+		addresses("Sender") if msg["Sender"] else from_,
+		addresses("Reply-To") if msg["Reply-To"] else from_,
+		addresses("To"),
+		addresses("Cc"),
+		addresses("Bcc"),
+		nstring(msg["In-Reply-To"]),
+		nstring(msg["Message-ID"]),
+	).encode()
+
+
+def quote(s):
+	s = str(s)
+	if any(c in s for c in "\r\n") or not s.isascii():
+		return literal(s.encode()).decode()
+	return '"' + s.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def literal(data):
+	return b"{" + str(len(data)).encode() + b"}\r\n" + data
+
+
+def tokenize_command(parts):
+	"""
+	Splits a command into atoms, strings and nested lists. Literals become strings.
+	"""
+	root = []
+	stack = [root]
+	token_p = re.compile(r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"\[]+(?:\[[^\]]*\])?(?:<[\d.]+>)?))')
+	for text, literal_data in parts:
+		text = text.decode("utf-8", errors="surrogateescape")
+		i = 0
+		while i < len(text):
+			m = token_p.match(text, i)
+			if not m or m.end() == i:
+				if text[i:].strip():
+					raise ValueError(f"Can't parse: {text[i:]!r}")
+				break
+			i = m.end()
+			open_paren, close_paren, quoted, atom = m.groups()
+			if open_paren:
+				stack.append([])
+				stack[-2].append(stack[-1])
+			elif close_paren:
+				stack.pop()
+			elif quoted is not None:
+				stack[-1].append(re.sub(r"\\(.)", r"\1", quoted))
+			elif atom is not None:
+				stack[-1].append(atom)
+		if literal_data is not None:
+			stack[-1].append(literal_data.decode("utf-8", errors="surrogateescape"))
+	return root
+
+
+def decode_header(value):
+	"""
+	Decodes RFC 2047 encoded words, such as "=?utf-8?q?Caf=C3=A9?=", that SEARCH has to match as decoded text.
+	"""
+	return str(email.header.make_header(email.header.decode_header(str(value))))
+
+
+def parse_sequence_set(s, *, largest):
+	result = set()
+	for part in str(s).split(","):
+		if ":" in part:
+			a, b = part.split(":")
+			a = largest if a == "*" else int(a)
+			b = largest if b == "*" else int(b)
+			result.update(range(min(a, b), max(a, b) + 1))
+		else:
+			result.add(largest if part == "*" else int(part))
+	return result
+
+
+def parse_imap_date(s):
+	return datetime.datetime.strptime(s, "%d-%b-%Y").date()
+
+
+def parse_search_criteria(args, *, messages):
+	"""
+	Compiles search keys into a predicate of (message sequence number, message), all keys must match.
+	"""
+	largest_uid = messages[-1].uid if messages else 0
+
+	def parse_key():
+		key = args.pop(0)
+		if isinstance(key, list):
+			criteria = parse_all(key)
+			return criteria
+		upper = key.upper()
+		flag_keys = {
+			"SEEN": "\\Seen", "FLAGGED": "\\Flagged", "ANSWERED": "\\Answered", "DELETED": "\\Deleted", "DRAFT": "\\Draft",
+		}
+		if upper == "ALL":
+			return lambda n, m: True
+		if upper in flag_keys:
+			return lambda n, m, f=flag_keys[upper]: f in m.flags
+		if upper.startswith("UN") and upper[2:] in flag_keys:
+			return lambda n, m, f=flag_keys[upper[2:]]: f not in m.flags
+		if upper in ("NEW", "RECENT"):
+			return lambda n, m: False
+		if upper == "OLD":
+			return lambda n, m: True
+		if upper == "NOT":
+			criteria = parse_key()
+			return lambda n, m: not criteria(n, m)
+		if upper == "OR":
+			a, b = parse_key(), parse_key()
+			return lambda n, m: a(n, m) or b(n, m)
+		if upper in ("SINCE", "BEFORE", "ON"):
+			date = parse_imap_date(args.pop(0))
+			compare = {"SINCE": lambda d: d >= date, "BEFORE": lambda d: d < date, "ON": lambda d: d == date}[upper]
+			return lambda n, m: compare(m.internaldate.date())
+		if upper in ("SENTSINCE", "SENTBEFORE", "SENTON"):
+			date = parse_imap_date(args.pop(0))
+			compare = {"SENTSINCE": lambda d: d >= date, "SENTBEFORE": lambda d: d < date, "SENTON": lambda d: d == date}[upper]
+			return lambda n, m: compare(email.utils.parsedate_to_datetime(m.parsed["Date"]).date())
+		if upper in ("FROM", "TO", "CC", "BCC", "SUBJECT"):
+			value = args.pop(0).lower()
+			header = upper.capitalize()
+			return lambda n, m: value in decode_header(m.parsed.get(header, "")).lower()
+		if upper == "HEADER":
+			header, value = args.pop(0), args.pop(0).lower()
+			return lambda n, m: value in decode_header(m.parsed.get(header, "")).lower()
+		if upper in ("BODY", "TEXT"):
+			value = args.pop(0).lower().encode()
+			return lambda n, m: value in (m.text if upper == "BODY" else m.data).lower()
+		if upper in ("LARGER", "SMALLER"):
+			size = int(args.pop(0))
+			return (lambda n, m: len(m.data) > size) if upper == "LARGER" else (lambda n, m: len(m.data) < size)
+		if upper == "UID":
+			uids = parse_sequence_set(args.pop(0), largest=largest_uid)
+			return lambda n, m: m.uid in uids
+		if upper == "MODSEQ":
+			modseq = int(args.pop(0))
+			return lambda n, m: m.modseq >= modseq
+		if re.fullmatch(r"[\d*:,]+", key):
+			numbers = parse_sequence_set(key, largest=len(messages))
+			return lambda n, m: n in numbers
+		raise ValueError(f"Unsupported search key {key}")
+
+	def parse_all(keys):
+		nonlocal args
+		saved, args = args, list(keys)
+		criteria = []
+		while args:
+			criteria.append(parse_key())
+		args = saved
+		return lambda n, m: all(c(n, m) for c in criteria)
+
+	return parse_all(args)
+
+
+def create_ssl_context():
+	"""
+	A server context with a throwaway self-signed certificate, clients have to skip verification.
+	"""
+	with tempfile.TemporaryDirectory() as d:
+		cert, key = pathlib.Path(d, "cert.pem"), pathlib.Path(d, "key.pem")
+		subprocess.run(
+			[
+				"openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+				"-subj", "/CN=localhost", "-keyout", str(key), "-out", str(cert),
+			],
+			check=True,
+			stdout=subprocess.DEVNULL,
+			stderr=subprocess.DEVNULL,
+		)
+		context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+		context.load_cert_chain(cert, key)
+	return context
+
+
+def parse_args(*, args, prog):
+	parser = argparse.ArgumentParser(prog=prog, description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--host", dest="host", action="store", default="127.0.0.1", help="address to listen on")
+	parser.add_argument("--port", dest="port", action="store", type=int, default=0, help="port to listen on, random by default")
+	parser.add_argument("--user", dest="username", action="store", default="test", help="username clients log in with")
+	parser.add_argument("--password", dest="password", action="store", default="test", help="password clients log in with")
+	parser.add_argument(
+		"--maildir", dest="maildirs", action="append", metavar="PATH", type=pathlib.Path, default=[],
+		help="load mailboxes from a Maildir++ directory",
+	)
+	parser.add_argument(
+		"--generate", dest="generate", action="append", metavar="[MAILBOX=]COUNT", default=[],
+		help="add COUNT generated messages to MAILBOX, INBOX by default",
+	)
+	parser.add_argument(
+		"--latency", dest="latency", action="store", metavar="SECONDS", type=float, default=0.0,
+		help="delay before responding to every command",
+	)
+	parser.add_argument(
+		"--deliver-every", dest="deliver_every", action="store", metavar="SECONDS", type=float, default=None,
+		help="add a generated message to INBOX periodically",
+	)
+	parser.add_argument("--verbose", "-v", dest="verbose", action="store_true", default=False, help="log commands to stderr")
+	parser.add_argument("--seed", dest="seed", action="store", type=int, default=0, help="seed of the message generator")
+	return vars(parser.parse_args(args))
+
+
+def smain(argv=None):
+	if argv is None:
+		argv = sys.argv
+	try:
+		return asyncio.run(main(**parse_args(args=argv[1:], prog=argv[0])))
+	except KeyboardInterrupt:
+		print(file=sys.stderr)
+
+
+if __name__ == "__main__":
+	sys.exit(smain())
@@ -6,7 +6,8 @@
 # ]
 # ///
 
-import sys, urllib.parse, imaplib, ssl, getpass, hmac, email, email.policy, shlex, subprocess, re, json
+import sys, urllib.parse, imaplib, ssl, getpass, hmac, email, email.policy, email.headerregistry, shlex, subprocess, re, json, collections
+import pathlib, sqlite3, datetime, itertools, threading, contextlib, functools, fnmatch, concurrent.futures, tempfile, shutil, time
 from typing import Any
 from imapclient import imap_utf7
 
@@ -19,19 +20,85 @@ def main(opts: Any) -> None:
 	global verbosity
 	verbosity = opts.verbosity
 
-	url = urllib.parse.urlsplit(opts.account)
-	assert url.scheme == "imaps", (opts.account, url)
-	assert not url.fragment,      (opts.account, url)
+	if opts.password_from:
+		with open(opts.password_from, "r") as fo:
+			opts.password = fo.read().rstrip("\n")
+
+	accounts = [parse_account(opts, account) for account in opts.accounts or [None]]
+	assert not (opts.envelope_only and (opts.show_in_json or opts.show_in_mbox)), "--envelope only works with the markdown output"
+
+	if opts.crawl_pattern is not None:
+		mbox_out = open_mbox_output(opts.show_in_mbox)
+
+		def get_content(*, conn, account, mailbox):
+			if mbox_out is not None:
+				# Exported to a temporary file so that mailboxes exported concurrently aren't interleaved.
+				spool = tempfile.TemporaryFile()
+				export_mailbox_mbox(conn=conn, mailbox=mailbox, search_criteria=opts.search_criteria, fetch_chunk_size=opts.fetch_chunk_size, out=spool)
+				return spool
+			return get_mailbox_content(
+				conn=conn, mailbox=mailbox, flagged_only=opts.flagged_only, unseen_only=opts.unseen_only,
+				search_criteria=opts.search_criteria, fetch_chunk_size=opts.fetch_chunk_size,
+				header_cache=None if opts.no_cache else HeaderCache(opts.cache_path, account=account.key),
+				envelope_only=opts.envelope_only,
+			)
+
+		return crawl(
+			accounts=accounts,
+			mailbox_pattern=opts.crawl_pattern,
+			max_connections=opts.max_connections,
+			enable_condstore=not opts.no_cache,
+			get_content=get_content,
+			mbox_out=mbox_out,
+			show_in_json=opts.show_in_json,
+			hide_to_if=opts.hide_to_if,
+		)
+
+	assert len(accounts) == 1, "Multiple accounts can only be listed with --crawl"
+	account, = accounts
+	conn = connect(account, enable_condstore=not opts.no_cache)
+	if conn is None:
+		return
+
+	personal_ns_delimiter = get_personal_namespace_delimiter(conn)
+
+	path_sep = "/"
+	path = account.path.strip(path_sep)
+	path = [urllib.parse.unquote(i) for i in path.split(path_sep)] if path else []
+
+	if path:
+		mailbox = personal_ns_delimiter.join(path)
+		#TODO:vruyr:bugs Special chars, such as hierarchy delimiter, in path components should be escaped.
+		if opts.watch:
+			return watch_mailbox(
+				conn=conn, reconnect=lambda: connect(account), mailbox=mailbox,
+				search_criteria=opts.search_criteria, flagged_only=opts.flagged_only, unseen_only=opts.unseen_only,
+				show_in_json=opts.show_in_json, hide_to_if=opts.hide_to_if, poll_interval=opts.poll_interval,
+			)
+		header_cache = None if opts.no_cache else HeaderCache(opts.cache_path, account=account.key)
+		list_mailbox_content(conn=conn, mailbox=mailbox, mbox_out=open_mbox_output(opts.show_in_mbox), show_in_json=opts.show_in_json, flagged_only=opts.flagged_only, unseen_only=opts.unseen_only, search_criteria=opts.search_criteria, hide_to_if=opts.hide_to_if, fetch_chunk_size=opts.fetch_chunk_size, header_cache=header_cache, envelope_only=opts.envelope_only)
+	elif opts.show_status:
+		show_mailbox_statuses(conn=conn, show_in_json=opts.show_in_json)
+	else:
+		list_mailboxes(conn=conn, show_in_json=opts.show_in_json)
+
+
+class Account(collections.namedtuple("Account", ["server", "port", "username", "password", "path", "ssl_context"])):
+	@property
+	def key(self):
+		return f"{self.username}@{self.server}:{self.port}"
+
+
+def parse_account(opts, account_url):
+	url = urllib.parse.urlsplit(account_url)
+	assert url.scheme == "imaps", (account_url, url)
+	assert not url.fragment,      (account_url, url)
 	username, password, hostname, port = (url.username, url.password, url.hostname, url.port)
 	username = urllib.parse.unquote(username)
 	url_qs = urllib.parse.parse_qs(url.query)
 	url_qs_ssl = url_qs.pop("ssl", None)
 	assert not url_qs, url_qs
 
-	if opts.password_from:
-		with open(opts.password_from, "r") as fo:
-			opts.password = fo.read().rstrip("\n")
-
 	port     = port or imaplib.IMAP4_SSL_PORT
 	server   = opts.server   or hostname or input("Server Hostname: ")
 	username = opts.username or username or input("Username: ") or getpass.getuser()
@@ -50,7 +117,15 @@ def main(opts: Any) -> None:
 	else:
 		assert False, ("Unrecognized ssl query parameter value", url_qs_ssl)
 
-	conn = imaplib.IMAP4_SSL(server, port=port, ssl_context=ssl_context)
+	return Account(server=server, port=port, username=username, password=password, path=path, ssl_context=ssl_context)
+
+
+def connect(account: Account, *, enable_condstore=False):
+	"""
+	Returns an authenticated connection, or None if the server supports none of the known authentication mechanisms.
+	"""
+	username, password = account.username, account.password
+	conn = imaplib.IMAP4_SSL(account.server, port=account.port, ssl_context=account.ssl_context)
 
 	show_msg(2, "Server Capabilities: {}", ", ".join(conn.capabilities))
 
@@ -74,25 +149,24 @@ def main(opts: Any) -> None:
 			conn.authenticate("PLAIN", plain_responder)
 	else:
 		show_msg(-1, "Error: No known authentication mechanisms are supported by the server.")
-		return
+		conn.shutdown()
+		return None
+
+	if enable_condstore and "CONDSTORE" in conn.capabilities and "ENABLE" in conn.capabilities:
+		# So that SELECT reports HIGHESTMODSEQ for the header cache.
+		conn.enable("CONDSTORE")
 
+	return conn
+
+
+def get_personal_namespace_delimiter(conn: imaplib.IMAP4):
 	personal_ns, otherusers_ns, shared_ns = get_namespaces(conn)
 	assert len(personal_ns) == 1, personal_ns
 	personal_ns = personal_ns[0]
 	assert len(personal_ns) == 2, personal_ns
 	personal_ns_prefix, personal_ns_delimiter = personal_ns
 	assert personal_ns_prefix == "", (personal_ns_prefix,)
-
-	path_sep = "/"
-	path = path.strip(path_sep)
-	path = [urllib.parse.unquote(i) for i in path.split(path_sep)] if path else []
-
-	if path:
-		mailbox = personal_ns_delimiter.join(path)
-		#TODO:vruyr:bugs Special chars, such as hierarchy delimiter, in path components should be escaped.
-		list_mailbox_content(conn=conn, mailbox=mailbox, show_in_mbox=opts.show_in_mbox, show_in_json=opts.show_in_json, flagged_only=opts.flagged_only, hide_to_if=opts.hide_to_if)
-	else:
-		list_mailboxes(conn=conn, show_in_json=opts.show_in_json)
+	return personal_ns_delimiter
 
 
 def get_namespaces(conn: imaplib.IMAP4):
@@ -158,87 +232,896 @@ email_policy = EmailPolicy(
 )
 
 
-def list_mailbox_content(*, conn: imaplib.IMAP4, mailbox, show_in_mbox, show_in_json, flagged_only, hide_to_if):
-		hide_to_if = set(hide_to_if)
+def list_mailbox_content(*, conn: imaplib.IMAP4, mailbox, mbox_out=None, show_in_json, flagged_only, unseen_only=False, search_criteria=None, hide_to_if, fetch_chunk_size, header_cache=None, envelope_only=False):
+	if mbox_out is not None:
+		export_mailbox_mbox(conn=conn, mailbox=mailbox, search_criteria=search_criteria, fetch_chunk_size=fetch_chunk_size, out=mbox_out)
+		return
+	msgs = get_mailbox_content(conn=conn, mailbox=mailbox, flagged_only=flagged_only, unseen_only=unseen_only, search_criteria=search_criteria, fetch_chunk_size=fetch_chunk_size, header_cache=header_cache, envelope_only=envelope_only)
+	if msgs is not None:
+		write_mailbox_content(msgs, show_in_json=show_in_json, hide_to_if=hide_to_if)
+
+
+def select_mailbox(*, conn: imaplib.IMAP4, mailbox):
+		"""
+		Selects the mailbox read-only, returns whether it succeeded.
+		"""
 		mailbox = imap_utf7_encode(mailbox)
 		mailbox = b'"' + mailbox + b'"' #TODO Why do we need to quotes here and what happens if the name already has a quote.
 		response_type, response_data = conn.select(mailbox, readonly=True)
 		if response_type != "OK":
 			show_msg(-1, "{!r}, {!r}", response_type, response_data)
-			return
+			return False
+		return True
+
+
+def select_and_search(*, conn: imaplib.IMAP4, mailbox, search_criteria):
+		"""
+		Selects the mailbox read-only and returns the UIDs of messages matching the search criteria, or None if it can't be
+		selected.
+		"""
+		if not select_mailbox(conn=conn, mailbox=mailbox):
+			return None
 
-		response_type, response_data = conn.search(None, "ALL")
+		response_type, response_data = uid_search(conn, *search_criteria)
 		assert response_type == "OK", (response_type, response_data)
 		assert len(response_data) == 1
 		if response_data == [None]:
 			print("(empty)")
-			return
+			return None
+
+		return [int(uid) for uid in response_data[0].split()]
+
+
+def get_mailbox_content(*, conn: imaplib.IMAP4, mailbox, flagged_only, unseen_only=False, search_criteria=None, fetch_chunk_size, header_cache=None, envelope_only=False):
+		"""
+		Returns [(msg, flags)] of the mailbox sorted by date, or None if it can't be selected. With envelope_only the
+		messages are EnvelopeMessage objects that only have the headers format_message_line() needs.
+		"""
+		search_criteria = search_criteria or ["ALL"]
+		uids = select_and_search(conn=conn, mailbox=mailbox, search_criteria=search_criteria)
+		if uids is None:
+			return None
 
 		msgs = []
 		msg_fetch_parts = b"(FLAGS BODY.PEEK[HEADER])"
-		msg_fetch_response_pattern = re.compile(rb"(?P<msgn>\d+) \((?P<flags>FLAGS \((?:.*?)\)) BODY\[HEADER\] \{(?P<size>\d+)\}")
-
-		msgns = response_data[0].split()
-		for msgn in msgns:
-			#TODO:vruyr If show_in_mbox or show_in_json is true, fetch all the parts, not just the header.
-			response_type, response_data = conn.fetch(msgn, msg_fetch_parts)
-			assert response_type == "OK", (response_type, response_data)
-			try:
-				(envelope_start, message_data), envelope_end = response_data
-			except:
-				print(response_data)
-				raise
-			m = msg_fetch_response_pattern.match(envelope_start)
-			if not m:
-				print("Pattern:", msg_fetch_response_pattern)
-				print("Response: ", envelope_start)
-				assert False
-			m = m.groupdict()
-			assert sorted(m.keys()) == ["flags", "msgn", "size"], m
-			assert m["msgn"] == msgn, (msgn, m)
-			assert int(m["size"]) == len(message_data), (m, message_data)
-			assert envelope_end == b")"
-			flags = set(f.decode("ASCII") for f in imaplib.ParseFlags(m["flags"]))
-			if "\\Seen" not in flags:
-				flags.add("\\Unseen")
-			flags -= {"\\Seen", "\\Answered"}
-			if flagged_only:
-				if "\\Flagged" not in flags:
-					continue
-				flags.remove("\\Flagged")
-			msg = email.message_from_bytes(message_data, policy=email_policy)
+
+		#TODO:vruyr If show_in_json is true, fetch all the parts, not just the header.
+		if envelope_only:
+			for uid, attributes in gen_uid_fetch(conn, uids, ENVELOPE_FETCH_PARTS, chunk_size=fetch_chunk_size):
+				flags = simplify_flags(attributes["FLAGS"], flagged_only=flagged_only, unseen_only=unseen_only)
+				msgs.append((EnvelopeMessage(attributes), flags))
+			headers = []
+		elif header_cache is None:
+			headers = (
+				(uid, attributes["FLAGS"], attributes["BODY[HEADER]"])
+					for uid, attributes in gen_uid_fetch(conn, uids, msg_fetch_parts, chunk_size=fetch_chunk_size)
+			)
+		else:
+			all_uids = uids
+			if search_criteria != ["ALL"]:
+				# The cache needs to know about all the messages to notice the expunged ones.
+				response_type, response_data = conn.uid("SEARCH", None, "ALL")
+				assert response_type == "OK", (response_type, response_data)
+				all_uids = [int(uid) for uid in (response_data[0] or b"").split()]
+			headers = header_cache.sync(conn, mailbox, all_uids, wanted_uids=uids, chunk_size=fetch_chunk_size)
+		for uid, flags, header in headers:
+			flags = simplify_flags(flags, flagged_only=flagged_only, unseen_only=unseen_only)
+			msg = email.message_from_bytes(header, policy=email_policy)
 			msgs.append((msg, flags))
 
 		msgs.sort(key=lambda msg_and_flags: email.utils.parsedate_to_datetime(msg_and_flags[0]["Date"]))
-		if show_in_mbox:
-			for msg, flags in msgs:
-				sys.stdout.buffer.write(msg.as_bytes(unixfrom=True, policy=email_policy))
-				sys.stdout.buffer.write(b"\r\n\r\n")
-		elif show_in_json:
-			json.dump(
-				[
-					msg.as_string(unixfrom=False, maxheaderlen=0, policy=email_policy) for msg, flags in msgs
-				],
-				sys.stdout,
-				indent=4
-			)
+		return msgs
+
+
+def write_mailbox_content(msgs, *, show_in_json, hide_to_if):
+		hide_to_if = set(hide_to_if)
+		if show_in_json:
+			json.dump(format_messages_for_json(msgs), sys.stdout, indent=4)
 			sys.stdout.write("\n")
 		else:
 			for msg, flags in msgs:
-				# the_date = "{:<code>%Y-%m-%d</code> ⏱️ <code>%H:%M</code>}".format(email.utils.parsedate_to_datetime(msg["Date"]).astimezone())
-				the_date = email.utils.parsedate_to_datetime(msg["Date"]).astimezone().isoformat()
-				the_from_name, the_from_address = parse_addressee_header(msg["From"])
-				the_to_name, the_to_address = parse_addressee_header(msg["To"])
-				to_part = ""
-				if the_to_address not in hide_to_if:
-					to_part = f" ➤ {the_to_address}"
-				the_subject = msg["Subject"]
-				the_msgid = msg["Message-ID"]
-				print(f"- 📫 (date::{the_date}) ◇ [{the_from_name}](mailto:{the_from_address}){to_part} ◆ [{the_subject}](message:{urllib.parse.quote(the_msgid)})", end="")
-				if flags:
-					print(end=" ")
-					print(*((f"#{f[1:]}" if f.startswith("\\") else f"`{f}`") for f in flags), sep=", ", end="")
-				print(end="\n")
+				print(format_message_line(msg, flags, hide_to_if=hide_to_if))
+
+
+ENVELOPE_FETCH_PARTS = b"(FLAGS INTERNALDATE RFC822.SIZE ENVELOPE)"
+
+
+class EnvelopeMessage(object):
+	"""
+	The headers of a message that are part of its ENVELOPE, decoded the way the email package would present them,
+	without downloading and parsing the whole header.
+	"""
+	__slots__ = ("headers", "internaldate", "size")
+
+	def __init__(self, attributes):
+		date, subject, from_, sender, reply_to, to, cc, bcc, in_reply_to, message_id = attributes["ENVELOPE"]
+		self.headers = {
+			"Date": decode_envelope_text(date),
+			"Subject": decode_envelope_text(subject),
+			"From": format_envelope_addresses(from_),
+			"Sender": format_envelope_addresses(sender),
+			"Reply-To": format_envelope_addresses(reply_to),
+			"To": format_envelope_addresses(to),
+			"Cc": format_envelope_addresses(cc),
+			"Bcc": format_envelope_addresses(bcc),
+			"In-Reply-To": decode_envelope_text(in_reply_to),
+			"Message-ID": decode_envelope_text(message_id),
+		}
+		self.internaldate = parse_internaldate(attributes["INTERNALDATE"])
+		self.size = attributes["RFC822.SIZE"]
+
+	def __getitem__(self, name):
+		return self.headers.get(name)
+
+
+def decode_envelope_text(value):
+	if value is None:
+		return None
+	text = value.decode("utf-8", errors="replace")
+	text = re.sub(r"[ \t]+", " ", "".join(text.splitlines())).strip(" \t")
+	if "=?" in text:
+		# Encoded words are rare enough to leave to the email package.
+		text = str(email_policy.header_fetch_parse("Subject", text))
+	return text
+
+
+def format_envelope_addresses(addresses):
+	"""
+	Formats ENVELOPE addresses, including group syntax, the way the email package formats a parsed address header.
+	"""
+	if addresses is None:
+		return None
+	items = []
+	group = None
+	for name, adl, mailbox, host in addresses:
+		if host is None and mailbox is not None:
+			group = email.headerregistry.Group(decode_envelope_text(mailbox), [])
+		elif host is None:
+			if group is not None:
+				items.append(group)
+			group = None
+		else:
+			address = email.headerregistry.Address(
+				display_name=decode_envelope_text(name) or "",
+				username=mailbox.decode("utf-8", errors="replace"),
+				domain=host.decode("utf-8", errors="replace"),
+			)
+			if group is None:
+				items.append(address)
+			else:
+				group = email.headerregistry.Group(group.display_name, [*group.addresses, address])
+	# Some servers leave out the end of a group that is the last one in the header.
+	if group is not None:
+		items.append(group)
+	return ", ".join(str(item) for item in items)
+
+
+def simplify_flags(flags, *, flagged_only=False, unseen_only=False):
+	flags = set(flags)
+	if "\\Seen" not in flags:
+		flags.add("\\Unseen")
+	flags -= {"\\Seen", "\\Answered"}
+	# Flags that every listed message has because of the search criteria are not worth showing.
+	if flagged_only:
+		flags.discard("\\Flagged")
+	if unseen_only:
+		flags.discard("\\Unseen")
+	return flags
+
+
+def format_message_line(msg, flags, *, hide_to_if):
+	# the_date = "{:<code>%Y-%m-%d</code> ⏱️ <code>%H:%M</code>}".format(email.utils.parsedate_to_datetime(msg["Date"]).astimezone())
+	the_date = email.utils.parsedate_to_datetime(msg["Date"]).astimezone().isoformat()
+	the_from_name, the_from_address = parse_addressee_header(msg["From"])
+	the_to_name, the_to_address = parse_addressee_header(msg["To"])
+	to_part = ""
+	if the_to_address not in hide_to_if:
+		to_part = f" ➤ {the_to_address}"
+	the_subject = msg["Subject"]
+	the_msgid = msg["Message-ID"]
+	line = f"- 📫 (date::{the_date}) ◇ [{the_from_name}](mailto:{the_from_address}){to_part} ◆ [{the_subject}](message:{urllib.parse.quote(the_msgid)})"
+	if flags:
+		line += " " + ", ".join((f"#{f[1:]}" if f.startswith("\\") else f"`{f}`") for f in flags)
+	return line
+
+
+IDLE_DURATION = 29 * 60
+
+
+def watch_mailbox(*, conn: imaplib.IMAP4, reconnect, mailbox, search_criteria=None, flagged_only=False, unseen_only=False, show_in_json, hide_to_if, poll_interval):
+	"""
+	Outputs messages arriving in the mailbox, as markdown lines or as NDJSON, until interrupted. Waits with IDLE where
+	the server supports it and polls with NOOP otherwise.
+
+	Arrivals are tracked by UID, so after a dropped connection `reconnect()` is used to get a new one and messages that
+	arrived in the meantime are output once. If UIDVALIDITY changes while disconnected there is no telling which
+	messages are new, so watching restarts from UIDNEXT.
+	"""
+	hide_to_if = set(hide_to_if)
+	search_criteria = [] if search_criteria in (None, ["ALL"]) else search_criteria
+	last_uid = None
+	uidvalidity = None
+	failures = 0
+	while True:
+		try:
+			if conn is None:
+				conn = reconnect()
+				assert conn is not None, "Can't authenticate"
+				print("Reconnected.", file=sys.stderr)
+			if not select_mailbox(conn=conn, mailbox=mailbox):
+				return 1
+			current_uidvalidity = int(conn.response("UIDVALIDITY")[1][-1])
+			uidnext = conn.response("UIDNEXT")[1][-1]
+			if last_uid is None or current_uidvalidity != uidvalidity:
+				if last_uid is not None:
+					print("Warning: UIDVALIDITY of the mailbox changed, messages that arrived while disconnected are skipped.", file=sys.stderr)
+				if uidnext is None:
+					response_type, response_data = conn.uid("SEARCH", None, "UID", "*")
+					assert response_type == "OK", (response_type, response_data)
+					uidnext = max([0, *(int(uid) for uid in (response_data[0] or b"").split())]) + 1
+				last_uid = int(uidnext) - 1
+				uidvalidity = current_uidvalidity
+			failures = 0
+
+			while True:
+				# "N:*" always includes the last message, even if its UID is below N.
+				response_type, response_data = conn.uid("SEARCH", None, "UID", f"{last_uid + 1}:*")
+				assert response_type == "OK", (response_type, response_data)
+				new = sorted(uid for uid in (int(uid) for uid in (response_data[0] or b"").split()) if uid > last_uid)
+				if new and search_criteria:
+					response_type, response_data = uid_search(conn, "UID", format_sequence_set(new), *search_criteria)
+					assert response_type == "OK", (response_type, response_data)
+					matching = set(int(uid) for uid in (response_data[0] or b"").split())
+				else:
+					matching = set(new)
+				fetched = dict(gen_uid_fetch(conn, sorted(matching), b"(FLAGS BODY.PEEK[HEADER])"))
+				for uid in new:
+					if uid in fetched:
+						attributes = fetched[uid]
+						flags = simplify_flags(attributes["FLAGS"], flagged_only=flagged_only, unseen_only=unseen_only)
+						msg = email.message_from_bytes(attributes["BODY[HEADER]"], policy=email_policy)
+						if show_in_json:
+							print(json.dumps({
+								"uid": uid,
+								"flags": sorted(flags),
+								"message": msg.as_string(unixfrom=False, maxheaderlen=0, policy=email_policy),
+							}))
+						else:
+							print(format_message_line(msg, flags, hide_to_if=hide_to_if))
+					last_uid = uid
+				sys.stdout.flush()
+
+				if "IDLE" in conn.capabilities:
+					with conn.idle(duration=IDLE_DURATION) as idler:
+						# Waits until the server announces something, or the duration runs out to renew IDLE before
+						# servers time it out.
+						list(idler.burst())
+				else:
+					time.sleep(poll_interval)
+					conn.noop()
+		except (imaplib.IMAP4.abort, OSError) as e:
+			failures += 1
+			delay = min(60, 2 ** failures)
+			print(f"Warning: Connection lost ({type(e).__name__}: {e}), reconnecting in {delay} seconds.", file=sys.stderr)
+			if conn is not None:
+				try:
+					conn.shutdown()
+				except Exception:
+					pass
+				conn = None
+			time.sleep(delay)
+		except KeyboardInterrupt:
+			return None
+
+
+MBOX_PART_SIZE = 1 << 20
+
+
+def export_mailbox_mbox(*, conn: imaplib.IMAP4, mailbox, search_criteria=None, fetch_chunk_size, out):
+	"""
+	Writes full messages of the mailbox to the binary file `out` as mboxrd records ordered by INTERNALDATE, as they
+	arrive. Small messages are fetched several at a time up to MBOX_PART_SIZE bytes, larger ones in parts of that size,
+	so memory use doesn't depend on the size of the mailbox or of its messages.
+	"""
+	uids = select_and_search(conn=conn, mailbox=mailbox, search_criteria=search_criteria or ["ALL"])
+	if uids is None:
+		return
+
+	internaldates_and_sizes = {
+		uid: (parse_internaldate(attributes["INTERNALDATE"]), attributes["RFC822.SIZE"])
+			for uid, attributes in gen_uid_fetch(conn, uids, b"(INTERNALDATE RFC822.SIZE)", chunk_size=fetch_chunk_size)
+	}
+
+	batch = []
+	batch_size = 0
+
+	def write_batch():
+		nonlocal batch, batch_size
+		if batch:
+			fetched = dict(gen_uid_fetch(conn, batch, b"(BODY.PEEK[])", chunk_size=len(batch)))
+			for uid in batch:
+				if uid in fetched:
+					write_mbox_record(out, internaldates_and_sizes[uid][0], [fetched[uid]["BODY[]"]])
+			out.flush()
+		batch, batch_size = [], 0
+
+	for uid in sorted(internaldates_and_sizes, key=lambda uid: (internaldates_and_sizes[uid][0], uid)):
+		internaldate, size = internaldates_and_sizes[uid]
+		if batch_size + size > MBOX_PART_SIZE:
+			write_batch()
+		if size > MBOX_PART_SIZE:
+			write_mbox_record(out, internaldate, gen_message_parts(conn, uid))
+			out.flush()
+		else:
+			batch.append(uid)
+			batch_size += size
+	write_batch()
+
+
+def gen_message_parts(conn: imaplib.IMAP4, uid, *, part_size=MBOX_PART_SIZE):
+	"""
+	Fetches the full message with a partial FETCH per `part_size` bytes and yields the parts.
+	"""
+	offset = 0
+	while True:
+		response_type, response_data = conn.uid("FETCH", str(uid), f"(BODY.PEEK[]<{offset}.{part_size}>)")
+		assert response_type == "OK", (response_type, response_data)
+		parts = [
+			attributes[f"BODY[]<{offset}>"]
+				for msgn, attributes in parse_fetch_response(response_data)
+					if attributes.get("UID") == uid and f"BODY[]<{offset}>" in attributes
+		]
+		if not parts or not parts[0]:
+			return
+		yield parts[0]
+		if len(parts[0]) < part_size:
+			return
+		offset += len(parts[0])
+
+
+mbox_from_line_pattern = re.compile(rb"^(>*From )", re.MULTILINE)
+
+
+def write_mbox_record(out, internaldate, parts):
+	"""
+	Writes a message given in parts as an mboxrd record, escaping "From " lines even when they span parts. Nothing is
+	written if there are no parts, e.g. if the message has been expunged.
+	"""
+	leftover = None
+	for part in parts:
+		if leftover is None:
+			out.write(b"From nobody " + time.asctime(internaldate.astimezone(datetime.timezone.utc).timetuple()).encode() + b"\r\n")
+			leftover = b""
+		data = leftover + part
+		i = data.rfind(b"\n") + 1
+		out.write(mbox_from_line_pattern.sub(rb">\1", data[:i]))
+		leftover = data[i:]
+	if leftover is None:
+		return
+	out.write(mbox_from_line_pattern.sub(rb">\1", leftover))
+	out.write(b"\r\n\r\n" if leftover else b"\r\n")
+
+
+def parse_internaldate(value):
+	"""
+	Parses an INTERNALDATE such as b" 1-Feb-2024 13:05:00 +0100".
+	"""
+	m = re.fullmatch(rb"\s*(\d{1,2})-([A-Za-z]{3})-(\d{4}) (\d{2}):(\d{2}):(\d{2}) ([+-])(\d{2})(\d{2})", value)
+	assert m, value
+	day, month, year, hour, minute, second, sign, tz_hours, tz_minutes = m.groups()
+	offset = datetime.timedelta(hours=int(tz_hours), minutes=int(tz_minutes)) * (-1 if sign == b"-" else 1)
+	return datetime.datetime(
+		int(year), IMAP_MONTHS.index(month.decode().capitalize()) + 1, int(day), int(hour), int(minute), int(second),
+		tzinfo=datetime.timezone(offset),
+	)
+
+
+FETCH_CHUNK_SIZE = 500
+FETCH_PIPELINE_DEPTH = 4
+
+
+def gen_uid_fetch(conn: imaplib.IMAP4, uids, parts, *, chunk_size=FETCH_CHUNK_SIZE, pipeline_depth=FETCH_PIPELINE_DEPTH):
+	"""
+	Fetches `parts` of the messages with the given UIDs, `chunk_size` UIDs per UID FETCH command and up to
+	`pipeline_depth` commands in flight, and yields (uid, attributes) in the order the server returns them.
+
+	imaplib has no public way to send a command without waiting for its completion, so this uses the same _command()
+	and _command_complete() that IMAP4.uid() does. Servers answer commands in order and untagged FETCH responses are
+	matched by UID, so it doesn't matter which command's completion collects them.
+	"""
+	wanted = set(uids)
+	uids = sorted(wanted)
+	names = fetch_response_names(parts)
+	chunks = [uids[i:i + chunk_size] for i in range(0, len(uids), chunk_size)]
+	pending = collections.deque()
+
+	def complete_oldest():
+		tag = pending.popleft()
+		response_type, response_data = conn._command_complete("UID", tag)
+		response_type, response_data = conn._untagged_response(response_type, response_data, "FETCH")
+		assert response_type == "OK", (response_type, response_data)
+		for msgn, attributes in parse_fetch_response(response_data):
+			uid = attributes.get("UID")
+			if uid not in wanted or not names <= attributes.keys():
+				# Unsolicited FETCH responses, such as flag changes made by other clients, which can also arrive for a
+				# message that is being fetched, before its solicited response.
+				continue
+			wanted.remove(uid)
+			yield uid, attributes
+
+	for chunk in chunks:
+		pending.append(conn._command("UID", "FETCH", format_sequence_set(chunk), parts))
+		if len(pending) >= pipeline_depth:
+			yield from complete_oldest()
+	while pending:
+		yield from complete_oldest()
+
+
+fetch_item_pattern = re.compile(rb"[^\s()\[<]+(?:\[[^\]]*\])?(?:<\d+(?:\.\d+)?>)?")
+
+
+def fetch_response_names(parts):
+	"""
+	Returns the names of attributes that a FETCH of `parts` such as b"(FLAGS BODY.PEEK[]<0.1024>)" responds with, as
+	parse_fetch_response returns them, e.g. {"FLAGS", "BODY[]<0>"}.
+	"""
+	return {
+		re.sub(r"<(\d+)\.\d+>$", r"<\1>", item.decode().upper().replace("BODY.PEEK[", "BODY[", 1))
+			for item in fetch_item_pattern.findall(parts)
+	}
+
+
+def format_sequence_set(numbers):
+	"""
+	Formats sorted message numbers or UIDs as an IMAP sequence set with ranges, e.g. [1, 2, 3, 5] as "1:3,5".
+	"""
+	ranges = []
+	for n in numbers:
+		if ranges and ranges[-1][1] + 1 == n:
+			ranges[-1][1] = n
+		else:
+			ranges.append([n, n])
+	return ",".join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+
+fetch_response_start_pattern = re.compile(rb"(\d+) \(")
+
+
+def parse_fetch_response(response_data):
+	"""
+	Parses FETCH response data as returned by imaplib and yields (message number, attributes) of every message, where
+	attributes map upper-cased names such as "UID", "FLAGS" and "BODY[HEADER]" to values returned by parse_imap_values.
+
+	imaplib returns a message without literals as a single bytes item and one with literals as a tuple per literal,
+	(text up to and including the literal size, literal), followed by the rest of the text as bytes.
+	"""
+	text, literals = b"", []
+	for item in [*response_data, None]:
+		if isinstance(item, tuple):
+			part, literal = item
+		else:
+			part, literal = item, None
+		if part is None or fetch_response_start_pattern.match(part):
+			if text:
+				yield parse_fetch_response_message(text, literals)
+			text, literals = b"", []
+		if part is None:
+			continue
+		text += part
+		if literal is not None:
+			literals.append(literal)
+
+
+def parse_fetch_response_message(text, literals):
+	m = fetch_response_start_pattern.match(text)
+	assert m, text
+	values = parse_imap_values(text[m.end(1):], literals)
+	assert len(values) == 1 and type(values[0]) == list and len(values[0]) % 2 == 0, (text, values)
+	values = values[0]
+	attributes = {}
+	for name, value in zip(values[0::2], values[1::2]):
+		attributes[name.upper()] = value
+	return int(m.group(1)), attributes
+
+
+imap_token_pattern = re.compile(rb"""
+	\s*(?:
+		(?P<open>\() | (?P<close>\)) |
+		"(?P<quoted>(?:[^"\\]|\\.)*)" |
+		\{(?P<literal>\d+)\+?\} |
+		(?P<atom>[^\s()"{\[]+(?:\[[^\]]*\])?(?:<\d+>)?)
+	)
+""", re.VERBOSE)
+
+
+def parse_imap_values(data, literals=()):
+	"""
+	Parses a sequence of IMAP values into a list, where parenthesized lists become lists, NIL becomes None, numbers
+	become int, other atoms (including ones like BODY[HEADER]<0>) become str, and quoted strings and literals become
+	bytes. Literal size markers are replaced by the next item of `literals`.
+	"""
+	literals = iter(literals)
+	stack = [[]]
+	i = 0
+	while m := imap_token_pattern.match(data, i):
+		i = m.end()
+		if m["open"]:
+			stack.append([])
+		elif m["close"]:
+			value = stack.pop()
+			stack[-1].append(value)
+		elif m["quoted"] is not None:
+			stack[-1].append(re.sub(rb"\\(.)", rb"\1", m["quoted"]))
+		elif m["literal"] is not None:
+			literal = next(literals)
+			assert len(literal) == int(m["literal"]), (m["literal"], len(literal))
+			stack[-1].append(literal)
+		elif m["atom"] == b"NIL":
+			stack[-1].append(None)
+		elif m["atom"].isdigit():
+			stack[-1].append(int(m["atom"]))
+		else:
+			stack[-1].append(m["atom"].decode("ASCII"))
+	assert not data[i:].strip(), (i, data)
+	assert len(stack) == 1, data
+	return stack[0]
+
+
+HEADER_CACHE_PATH = pathlib.Path.home() / ".cache" / pathlib.Path(__file__).stem / "headers.sqlite"
+
+
+class HeaderCache(object):
+	"""
+	Message headers and flags of mailboxes stored in SQLite, keyed by account, mailbox, UIDVALIDITY and UID.
+	"""
+
+	def __init__(self, path, *, account):
+		path.parent.mkdir(parents=True, exist_ok=True)
+		# Concurrent crawls write from several threads, each with its own HeaderCache, and wait for each other's
+		# transactions, which are kept short.
+		self.db = sqlite3.connect(path, timeout=60)
+		self.account = account
+		self.db.executescript("""
+			PRAGMA journal_mode = WAL;
+			CREATE TABLE IF NOT EXISTS mailboxes (
+				account TEXT NOT NULL,
+				mailbox TEXT NOT NULL,
+				uidvalidity INTEGER NOT NULL,
+				uidnext INTEGER NOT NULL,
+				highestmodseq INTEGER,
+				PRIMARY KEY (account, mailbox)
+			);
+			CREATE TABLE IF NOT EXISTS messages (
+				account TEXT NOT NULL,
+				mailbox TEXT NOT NULL,
+				uidvalidity INTEGER NOT NULL,
+				uid INTEGER NOT NULL,
+				flags TEXT NOT NULL,
+				header BLOB NOT NULL,
+				PRIMARY KEY (account, mailbox, uidvalidity, uid)
+			);
+		""")
+
+	def sync(self, conn: imaplib.IMAP4, mailbox, uids, *, wanted_uids=None, chunk_size=FETCH_CHUNK_SIZE):
+		"""
+		Brings the cache of the selected mailbox up to date and returns [(uid, flags, header)] of `wanted_uids`, all of
+		`uids` by default, in UID order. `uids` must be all the messages in the mailbox.
+
+		Only headers of wanted messages that aren't cached yet, i.e. ones that arrived since the last sync at or above
+		the cached UIDNEXT or weren't wanted before, are fetched. Flags of cached messages are refreshed with
+		CHANGEDSINCE when the server reports HIGHESTMODSEQ (CONDSTORE), otherwise by fetching just the flags.
+		"""
+		def get_response_code(code):
+			response_type, response_data = conn.response(code)
+			return int(response_data[-1]) if response_data[-1] is not None else None
+		uidvalidity, uidnext, highestmodseq = map(get_response_code, ["UIDVALIDITY", "UIDNEXT", "HIGHESTMODSEQ"])
+		assert uidvalidity is not None, "The server didn't report UIDVALIDITY"
+		key = (self.account, mailbox)
+		row = self.db.execute(
+			"SELECT uidvalidity, uidnext, highestmodseq FROM mailboxes WHERE account = ? AND mailbox = ?", key
+		).fetchone()
+		if row is None or row[0] != uidvalidity:
+			with self.db:
+				self.db.execute("DELETE FROM messages WHERE account = ? AND mailbox = ?", key)
+				self.db.execute(
+					"INSERT OR REPLACE INTO mailboxes (account, mailbox, uidvalidity, uidnext, highestmodseq) VALUES (?, ?, ?, 1, NULL)",
+					(*key, uidvalidity)
+				)
+			row = (uidvalidity, 1, None)
+		cached_uidnext, cached_highestmodseq = row[1:]
+		key = (*key, uidvalidity)
+		cached = dict(self.db.execute(
+			"SELECT uid, flags FROM messages WHERE account = ? AND mailbox = ? AND uidvalidity = ?", key
+		))
+
+		expunged = cached.keys() - set(uids)
+		with self.db:
+			self.db.executemany(
+				"DELETE FROM messages WHERE account = ? AND mailbox = ? AND uidvalidity = ? AND uid = ?",
+				((*key, uid) for uid in expunged)
+			)
+		known = sorted(cached.keys() - expunged)
+		wanted_uids = set(uids if wanted_uids is None else wanted_uids)
+		new = sorted(wanted_uids - cached.keys())
+
+		changed_flags = []
+		if not known:
+			pass
+		elif highestmodseq is not None and cached_highestmodseq is not None:
+			if highestmodseq != cached_highestmodseq:
+				response_type, response_data = conn.uid(
+					"FETCH", f"1:{known[-1]}", f"(FLAGS) (CHANGEDSINCE {cached_highestmodseq})"
+				)
+				assert response_type == "OK", (response_type, response_data)
+				changed_flags = [
+					(attributes["UID"], attributes["FLAGS"])
+						for msgn, attributes in parse_fetch_response(response_data)
+							if attributes.get("UID") in cached
+				]
+		else:
+			changed_flags = [
+				(uid, attributes["FLAGS"]) for uid, attributes in gen_uid_fetch(conn, known, b"(FLAGS)", chunk_size=chunk_size)
+			]
+		with self.db:
+			self.db.executemany(
+				"UPDATE messages SET flags = ? WHERE account = ? AND mailbox = ? AND uidvalidity = ? AND uid = ?",
+				((" ".join(flags), *key, uid) for uid, flags in changed_flags)
+			)
+
+		fetched = gen_uid_fetch(conn, new, b"(FLAGS BODY.PEEK[HEADER])", chunk_size=chunk_size)
+		for batch in itertools.batched(fetched, chunk_size):
+			with self.db:
+				self.db.executemany(
+					"INSERT OR REPLACE INTO messages (account, mailbox, uidvalidity, uid, flags, header) VALUES (?, ?, ?, ?, ?, ?)",
+					((*key, uid, " ".join(attributes["FLAGS"]), attributes["BODY[HEADER]"]) for uid, attributes in batch)
+				)
+
+		if uidnext is None:
+			uidnext = max([cached_uidnext, *(uid + 1 for uid in uids)])
+		with self.db:
+			self.db.execute(
+				"INSERT OR REPLACE INTO mailboxes (account, mailbox, uidvalidity, uidnext, highestmodseq) VALUES (?, ?, ?, ?, ?)",
+				(*key, uidnext, highestmodseq)
+			)
+
+		return [
+			(uid, flags.split(), header) for uid, flags, header in self.db.execute(
+				"SELECT uid, flags, header FROM messages WHERE account = ? AND mailbox = ? AND uidvalidity = ? ORDER BY uid", key
+			) if uid in wanted_uids
+		]
+
+
+IMAP_MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def build_search_criteria(opts):
+	"""
+	Compiles the message selection options into UID SEARCH keys, all of which a message has to match.
+	"""
+	def imap_date(date):
+		return f"{date.day}-{IMAP_MONTHS[date.month - 1]}-{date.year}"
+
+	criteria, literals = [], []
+
+	def imap_string(key, s):
+		if s.isascii() and not any(c in s for c in "\r\n"):
+			criteria.extend([key, '"' + s.replace("\\", "\\\\").replace('"', '\\"') + '"'])
+		else:
+			literals.append((key, s.encode()))
+
+	if opts.flagged_only:
+		criteria.append("FLAGGED")
+	if opts.unseen_only:
+		criteria.append("UNSEEN")
+	if opts.since is not None:
+		criteria.extend(["SINCE", imap_date(opts.since)])
+	if opts.before is not None:
+		criteria.extend(["BEFORE", imap_date(opts.before)])
+	for address in opts.from_:
+		imap_string("FROM", address)
+	for text in opts.subject:
+		imap_string("SUBJECT", text)
+	if opts.larger is not None:
+		criteria.extend(["LARGER", str(opts.larger)])
+	# imaplib sends the literal of a command after all of its arguments, and only one.
+	if len(literals) > 1:
+		raise ValueError("Only one --from or --subject can have non-ASCII characters")
+	for key, literal in literals:
+		criteria.extend([key, literal])
+	return criteria
+
+
+def uid_search(conn: imaplib.IMAP4, *criteria):
+	"""
+	Runs UID SEARCH with the criteria from build_search_criteria, the last of which can be bytes to send in UTF-8 as a
+	literal.
+	"""
+	charset = None
+	if criteria and isinstance(criteria[-1], bytes):
+		conn.literal = criteria[-1]
+		criteria, charset = criteria[:-1], "CHARSET UTF-8"
+	return conn.uid("SEARCH", charset, *criteria)
+
+
+def parse_size(s):
+	"""
+	Parses a byte count with an optional K, M or G suffix, e.g. 512, 100K or 2M.
+	"""
+	m = re.fullmatch(r"(\d+)([KMG]?)", s.strip().upper())
+	if not m:
+		raise ValueError(f"Invalid size: {s!r}")
+	number, suffix = m.groups()
+	return int(number) * 1024 ** " KMG".index(suffix or " ")
+
+
+class ConnectionPool(object):
+	"""
+	Authenticated connections to one server shared by threads, at most `size` of them open at a time across all the
+	accounts on the server. An idle connection of another account is closed to make room when the limit is reached.
+	"""
+
+	def __init__(self, size, *, connect):
+		self.size = size
+		self.connect = connect
+		self.idle = []
+		self.open_count = 0
+		self.condition = threading.Condition()
+
+	@contextlib.contextmanager
+	def connection(self, account):
+		conn = self.acquire(account)
+		try:
+			yield conn
+		except:
+			# The connection may be in the middle of a response, don't reuse it.
+			self.discard(conn)
+			raise
+		else:
+			with self.condition:
+				self.idle.append((account, conn))
+				self.condition.notify()
+
+	def acquire(self, account):
+		evicted = None
+		with self.condition:
+			while True:
+				for i, (idle_account, conn) in enumerate(self.idle):
+					if idle_account == account:
+						del self.idle[i]
+						return conn
+				if self.open_count < self.size:
+					self.open_count += 1
+					break
+				if self.idle:
+					idle_account, evicted = self.idle.pop(0)
+					break
+				self.condition.wait()
+		if evicted is not None:
+			logout_quietly(evicted)
+		try:
+			conn = self.connect(account)
+			assert conn is not None, ("Can't authenticate", account.key)
+			return conn
+		except:
+			with self.condition:
+				self.open_count -= 1
+				self.condition.notify()
+			raise
+
+	def discard(self, conn):
+		with self.condition:
+			self.open_count -= 1
+			self.condition.notify()
+		logout_quietly(conn)
+
+	def close(self):
+		with self.condition:
+			idle, self.idle = self.idle, []
+			self.open_count -= len(idle)
+		for account, conn in idle:
+			logout_quietly(conn)
+
+
+def logout_quietly(conn: imaplib.IMAP4):
+	try:
+		conn.logout()
+	except Exception:
+		pass
+
+
+def crawl(*, accounts, mailbox_pattern, max_connections, enable_condstore, get_content, mbox_out=None, show_in_json, hide_to_if):
+	"""
+	Lists the content of every mailbox matching the glob in every account concurrently, with at most `max_connections`
+	connections per server, and writes each mailbox out as soon as it's done, in completion order.
+	"""
+	pools = {}
+	for account in accounts:
+		if (account.server, account.port) not in pools:
+			pools[(account.server, account.port)] = ConnectionPool(
+				max_connections,
+				connect=functools.partial(connect, enable_condstore=enable_condstore),
+			)
+
+	def get_pool(account):
+		return pools[(account.server, account.port)]
+
+	def list_matching_mailboxes(account):
+		with get_pool(account).connection(account) as conn:
+			status, mailboxes = conn.list("\"\"", "*")
+			assert status == "OK", (status, mailboxes)
+		result = []
+		for mailbox in mailboxes:
+			entry = parse_imap_list_response_entry(imap_utf7_decode(mailbox))
+			if type(entry) != tuple:
+				show_msg(-1, "Warning: Can't parse a LIST response entry: {!r}", entry)
+				continue
+			tags, sep, path = entry
+			if "\\Noselect" in tags or "\\NonExistent" in tags:
+				continue
+			if fnmatch.fnmatchcase("/".join(path), mailbox_pattern):
+				result.append((sep.join(path), path))
+		return result
+
+	def get_crawled_mailbox_content(account, mailbox):
+		with get_pool(account).connection(account) as conn:
+			return get_content(conn=conn, account=account, mailbox=mailbox)
+
+	failed = False
+	try:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max_connections * len(pools)) as executor:
+			pending = {executor.submit(list_matching_mailboxes, account): (account, None) for account in accounts}
+			while pending:
+				done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+				for future in done:
+					account, path = pending.pop(future)
+					try:
+						result = future.result()
+					except Exception as e:
+						failed = True
+						where = account.key if path is None else "{}/{}".format(account.key, "/".join(path))
+						print(f"Error: {where}: {type(e).__name__}: {e}", file=sys.stderr)
+						continue
+					if path is None:
+						for mailbox, path in result:
+							pending[executor.submit(get_crawled_mailbox_content, account, mailbox)] = (account, path)
+					elif result is not None:
+						write_crawled_mailbox_content(
+							result, account=account, path=path,
+							mbox_out=mbox_out, show_in_json=show_in_json, hide_to_if=hide_to_if,
+						)
+	finally:
+		for pool in pools.values():
+			pool.close()
+	return 1 if failed else None
+
+
+def write_crawled_mailbox_content(content, *, account, path, mbox_out, show_in_json, hide_to_if):
+	if mbox_out is not None:
+		with content:
+			content.seek(0)
+			shutil.copyfileobj(content, mbox_out)
+		mbox_out.flush()
+	elif show_in_json:
+		print(json.dumps({"account": account.key, "path": path, "messages": format_messages_for_json(content)}))
+	else:
+		print("#", "/".join([account.key, *path]))
+		write_mailbox_content(content, show_in_json=False, hide_to_if=hide_to_if)
+		print()
+	sys.stdout.flush()
+
+
+def open_mbox_output(path):
+	if path is None:
+		return None
+	if path == "-":
+		return sys.stdout.buffer
+	return open(path, "wb")
+
+
+def format_messages_for_json(msgs):
+	return [
+		msg.as_string(unixfrom=False, maxheaderlen=0, policy=email_policy) for msg, flags in msgs
+	]
 
 
 def parse_addressee_header(s):
@@ -252,23 +1135,135 @@ def parse_addressee_header(s):
 
 
 def list_mailboxes(*, conn, show_in_json):
+	if show_in_json:
+		json.dump(get_mailboxes(conn), sys.stdout, indent=4)
+		sys.stdout.write("\n")
+	else:
+		# https://www.imapwiki.org/ClientImplementation/MailboxList
+		status, mailboxes = conn.list("\"\"", "*")
+		assert status == "OK"
+		for mailbox in mailboxes:
+			tags, sep, path = parse_imap_list_response_entry(imap_utf7_decode(mailbox))
+			print(" ".join(tags).ljust(12), sep.join(p for p in path))
+
+
+def get_mailboxes(conn):
+	"""
+	Returns [{"tags": [...], "path": [...]}] of every mailbox, what --json prints without --path.
+	"""
 	# https://www.imapwiki.org/ClientImplementation/MailboxList
 	status, mailboxes = conn.list("\"\"", "*")
 	assert status == "OK"
+	result = []
+	for mailbox in mailboxes:
+		tags, sep, path = parse_imap_list_response_entry(imap_utf7_decode(mailbox))
+		result.append({
+			"tags": list(tags),
+			"path": list(p for p in path),
+		})
+	return result
+
+
+STATUS_ITEMS = ["MESSAGES", "UNSEEN", "RECENT", "UIDNEXT"]
+STATUS_PIPELINE_DEPTH = 64
+
+
+def show_mailbox_statuses(*, conn, show_in_json):
+	result = []
+	for (tags, sep, path), status in get_mailbox_statuses(conn):
+		result.append({
+			"path": path,
+			"messages": status["MESSAGES"],
+			"unseen": status["UNSEEN"],
+			"recent": status["RECENT"],
+			"size": status.get("SIZE"),
+			# UIDNEXT is one more than the highest UID unless the newest messages were expunged.
+			"highest_uid": status["UIDNEXT"] - 1 if status["MESSAGES"] else None,
+		})
 	if show_in_json:
-		result = []
-		for mailbox in mailboxes:
-			tags, sep, path = parse_imap_list_response_entry(imap_utf7_decode(mailbox))
-			result.append({
-				"tags": list(tags),
-				"path": list(p for p in path),
-			})
 		json.dump(result, sys.stdout, indent=4)
 		sys.stdout.write("\n")
 	else:
-		for mailbox in mailboxes:
-			tags, sep, path = parse_imap_list_response_entry(imap_utf7_decode(mailbox))
-			print(" ".join(tags).ljust(12), sep.join(p for p in path))
+		columns = ["messages", "unseen", "recent", "size", "highest_uid"]
+		rows = [[c.replace("_", " ") for c in columns]]
+		rows.extend([("-" if entry[c] is None else str(entry[c])) for c in columns] for entry in result)
+		widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+		paths = ["mailbox", *("/".join(entry["path"]) for entry in result)]
+		for row, path in zip(rows, paths):
+			print(*(v.rjust(w) for v, w in zip(row, widths)), path)
+
+
+def get_mailbox_statuses(conn):
+	"""
+	Returns [((tags, sep, path), {item: value})] of every mailbox with a status, in LIST order. Uses a single LIST
+	command with RETURN (STATUS ...) if the server supports LIST-STATUS, otherwise pipelines a STATUS command per
+	mailbox the same way gen_uid_fetch() pipelines FETCH commands.
+	"""
+	items = [*STATUS_ITEMS, "SIZE"] if "STATUS=SIZE" in conn.capabilities else STATUS_ITEMS
+	items = "({})".format(" ".join(items))
+	if "LIST-STATUS" in conn.capabilities:
+		response_type, response_data = conn._simple_command("LIST", "\"\"", "*", "RETURN", f"(STATUS {items})")
+		response_type, response_data = conn._untagged_response(response_type, response_data, "LIST")
+	else:
+		response_type, response_data = conn.list("\"\"", "*")
+	assert response_type == "OK", (response_type, response_data)
+
+	mailboxes = []
+	for entry in response_data:
+		entry = parse_imap_list_response_entry(entry.decode("ASCII"))
+		if type(entry) != tuple:
+			show_msg(-1, "Warning: Can't parse a LIST response entry: {!r}", entry)
+			continue
+		tags, sep, path = entry
+		mailboxes.append((sep.join(path), (tags, sep, [imap_utf7_decode(p.encode("ASCII")) for p in path])))
+
+	if "LIST-STATUS" not in conn.capabilities:
+		pending = collections.deque()
+
+		def complete_oldest():
+			mailbox, tag = pending.popleft()
+			response_type, response_data = conn._command_complete("STATUS", tag)
+			if response_type != "OK":
+				show_msg(-1, "Warning: STATUS {} failed: {!r}", mailbox, response_data)
+
+		for mailbox, (tags, sep, path) in mailboxes:
+			if "\\Noselect" in tags or "\\NonExistent" in tags:
+				continue
+			pending.append((mailbox, conn._command("STATUS", '"' + mailbox + '"', items)))
+			if len(pending) >= STATUS_PIPELINE_DEPTH:
+				complete_oldest()
+		while pending:
+			complete_oldest()
+
+	response_type, response_data = conn.response("STATUS")
+	statuses = dict(parse_status_responses(response_data))
+	return [(entry, statuses[mailbox]) for mailbox, entry in mailboxes if mailbox in statuses]
+
+
+def parse_status_responses(response_data):
+	"""
+	Parses STATUS response data as returned by imaplib and yields (mailbox, {item: value}) of every mailbox, with the
+	mailbox name as it is on the wire.
+
+	Like FETCH, a response with a literal mailbox name comes as a (text, literal) tuple followed by the rest as bytes.
+	"""
+	responses = []
+	continued = False
+	for item in response_data:
+		if item is None:
+			continue
+		text, literal = item if isinstance(item, tuple) else (item, None)
+		if continued:
+			responses[-1][0] += text
+		else:
+			responses.append([text, []])
+		if literal is not None:
+			responses[-1][1].append(literal)
+		continued = literal is not None
+	for text, literals in responses:
+		mailbox, values = parse_imap_values(text, literals)
+		mailbox = mailbox if isinstance(mailbox, str) else mailbox.decode("ASCII")
+		yield mailbox, dict(zip(values[::2], values[1::2]))
 
 
 def imap_utf7_encode(x):
@@ -329,27 +1324,46 @@ def sysmain():
 	parser = argparse.ArgumentParser()
 
 	message_selection_options = parser.add_argument_group("Message Selection Options")
+	message_selection_options.add_argument("--crawl",   dest="crawl_pattern", action="store", nargs="?", const="*", default=None, metavar="GLOB", help="List the content of all mailboxes matching the glob, all by default, in all accounts concurrently.")
 	message_selection_options.add_argument("--flagged-only", "--flagged", dest="flagged_only", action="store_true", default=False, help="Only list flagged messages when listing a mailbox content.")
+	message_selection_options.add_argument("--unseen-only", "--unseen",   dest="unseen_only",  action="store_true", default=False, help="Only list unseen messages.")
+	message_selection_options.add_argument("--since",   dest="since",   action="store",  default=None, type=datetime.date.fromisoformat, metavar="YYYY-MM-DD", help="Only list messages received on or after the date.")
+	message_selection_options.add_argument("--before",  dest="before",  action="store",  default=None, type=datetime.date.fromisoformat, metavar="YYYY-MM-DD", help="Only list messages received before the date.")
+	message_selection_options.add_argument("--from",    dest="from_",   action="append", default=[],   metavar="ADDR",  help="Only list messages with the text in the From header, can be used multiple times.")
+	message_selection_options.add_argument("--subject", dest="subject", action="append", default=[],   metavar="TEXT",  help="Only list messages with the text in the subject, can be used multiple times.")
+	message_selection_options.add_argument("--larger",  dest="larger",  action="store",  default=None, type=parse_size, metavar="SIZE", help="Only list messages larger than SIZE bytes, K, M and G suffixes are accepted.")
 
 	output_options = parser.add_argument_group("Output Options")
 	output_options.add_argument("--json", "-j",     dest="show_in_json",        action="store_true", default=False)
 	output_options.add_argument("--verbose", "-v",  dest="verbosity",           action="count",      default=0, help="increase verbosity, can be used multiple times")
 	output_options.add_argument("--quiet", "-q",    dest="_negative_verbosity", action="count",      default=0, help="decrease verbosity, can be used multiple times")
-	output_options.add_argument("--mbox",           dest="show_in_mbox",        action="store_true", default=False, help="if both --json and --mbox is passed, --mbox takes precedence")
+	output_options.add_argument("--mbox",           dest="show_in_mbox",        action="store", nargs="?", const="-", default=None, metavar="MBOX_FILE", help="export full messages as mbox to the file or stdout, if both --json and --mbox is passed, --mbox takes precedence")
+	output_options.add_argument("--envelope",       dest="envelope_only",       action="store_true", default=False, help="list messages from their IMAP ENVELOPE instead of downloading and parsing their headers, not for --json or --mbox")
+	output_options.add_argument("--status",         dest="show_status",         action="store_true", default=False, help="instead of listing mailboxes, show their message, unseen and recent counts, size and highest UID")
+	output_options.add_argument("--watch",          dest="watch",               action="store_true", default=False, help="keep running and output messages as they arrive in the mailbox, one JSON object per line with --json")
+	output_options.add_argument("--poll-interval",  dest="poll_interval",       action="store",      default=60, type=float, metavar="SECONDS", help="how often to check for new messages with --watch if the server doesn't support IDLE, default is %(default)s")
 	output_options.add_argument("--hide-to-if",     dest="hide_to_if",          action="append",     default=[],    help="if the message was sent to an address not specified here, show it in the output")
 
 
 	connectivity = parser.add_argument_group("Connectivity")
-	connectivity.add_argument("--account", "-a",  dest="account",       action="store", metavar="IMAP_URL", help="IMAP account to connect to as an imap://user@hostname/mailbox/path url")
+	connectivity.add_argument("--account", "-a",  dest="accounts",      action="append", default=[], metavar="IMAP_URL", help="IMAP account to connect to as an imap://user@hostname/mailbox/path url, can be used multiple times with --crawl")
 	connectivity.add_argument("--server", "-s",   dest="server",        action="store",               metavar="HOST",     help="host name or IP address of the IMAP server")
 	connectivity.add_argument("--user", "-u",     dest="username",      action="store", default=None, metavar="USERNAME", help="default is {}".format(getpass.getuser()))
 	connectivity.add_argument("--password",       dest="password",      action="store",               metavar="PASSWORD")
 	connectivity.add_argument("--password-from",  dest="password_from", action="store",               metavar="PASSWORD_FILE")
 	connectivity.add_argument("--path", "-p",     dest="path",          action="store",               metavar="MAILBOX_PATH")
+	connectivity.add_argument("--max-connections", dest="max_connections", action="store", type=int, default=4, metavar="COUNT", help="maximum number of concurrent connections per server with --crawl, default is %(default)s")
+	connectivity.add_argument("--cache",          dest="cache_path",    action="store", type=pathlib.Path, default=HEADER_CACHE_PATH, metavar="SQLITE_FILE", help="where to cache message headers, default is %(default)s")
+	connectivity.add_argument("--no-cache",       dest="no_cache",      action="store_true", default=False, help="fetch all message headers from the server without caching them")
+	connectivity.add_argument("--fetch-chunk-size", dest="fetch_chunk_size", action="store", type=int, default=FETCH_CHUNK_SIZE, metavar="COUNT", help="number of messages per UID FETCH command, default is %(default)s")
 
 	opts = parser.parse_args()
 	opts.verbosity -= opts._negative_verbosity
 	del opts._negative_verbosity
+	try:
+		opts.search_criteria = build_search_criteria(opts)
+	except ValueError as e:
+		parser.error(str(e))
 	return main(opts)
 
 
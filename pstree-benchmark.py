@@ -0,0 +1,282 @@
+#!/usr/bin/env -S uv --quiet run --no-project --script --
+# https://peps.python.org/pep-0723/
+# https://github.com/astral-sh/uv
+# /// script
+# requires-python = ">=3.14,<4"
+# dependencies = [
+# ]
+# ///
+
+"""
+Times the stages of pstree.py - parsing `ps` output or reading /proc, building the trees, filtering and rendering - on
+synthetic process tables of different sizes and prints the results as JSON.
+"""
+
+import sys, argparse, locale, pathlib, importlib.util, random, tempfile, time, json, platform, os, datetime, io, re
+import contextlib
+
+
+def main(*, sizes, repeat, seed, output, check):
+	locale.setlocale(locale.LC_ALL, "")
+	pstree = load_pstree()
+	if check:
+		check_replay_at(pstree)
+		return
+
+	results = []
+	for size in sizes:
+		processes = generate_processes(size, seed=seed)
+		ps_output = format_ps_output(pstree, processes)
+		with tempfile.TemporaryDirectory(prefix="pstree-benchmark-") as procfs_root:
+			procfs_root = pathlib.Path(procfs_root)
+			write_procfs(procfs_root, processes)
+			sources = {
+				"ps": lambda: list(pstree.gen_resolved_start_times(
+					pstree.parse_ps_output(ps_output),
+					snapshot_time=datetime.datetime.now(),
+				)),
+				"procfs": lambda: list(pstree.gen_processes_procfs(root=procfs_root, lookup_user=USERS.__getitem__)),
+			}
+			filtered_rows = {}
+			for source, parse in sources.items():
+				stages, filtered_rows[source] = measure_stages(pstree, parse, repeat=repeat)
+				results.append({"source": source, "processes": size, "seconds": stages})
+				print(f"{source:6} {size:>7} " + " ".join(f"{k}={v:.4f}" for k, v in stages.items()), file=sys.stderr)
+			# Both sources must produce the same trees for their timings to be comparable.
+			if os.geteuid() == 0:
+				assert len(set(filtered_rows.values())) == 1, (size, filtered_rows)
+			else:
+				print("Not running as root, the synthetic /proc can't have processes of other users.", file=sys.stderr)
+
+	report = {
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"repeat": repeat,
+		"seed": seed,
+		"results": results,
+	}
+	json.dump(report, output, indent=4)
+	output.write("\n")
+
+
+def load_pstree():
+	path = pathlib.Path(__file__).with_name("pstree.py")
+	spec = importlib.util.spec_from_file_location("pstree", path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+
+def check_replay_at(pstree):
+	"""
+	Records snapshots that spawn and kill processes and checks that `--replay --at` shows the ones of the right snapshot.
+	"""
+	start_time = datetime.datetime(2024, 1, 1, 11, 0, 0)
+	snapshot_pids = {
+		datetime.datetime(2024, 1, 1, 12, 0, 0): [1, 10, 11],
+		datetime.datetime(2024, 1, 1, 12, 0, 1): [1, 10, 12],
+		datetime.datetime(2024, 1, 1, 12, 0, 2): [1, 12, 13],
+	}
+	snapshots = [
+		(t, [
+			dict(
+				pid=pid, ppid=1, pgid=pid, user="root", rss="1024", cputime=datetime.timedelta(),
+				threads=1, lstart=start_time, args=f"/usr/bin/process-{pid}",
+			) for pid in pids
+		]) for t, pids in snapshot_pids.items()
+	]
+	with tempfile.TemporaryDirectory(prefix="pstree-benchmark-") as records_dir:
+		records_path = pathlib.Path(records_dir) / "snapshots.ndjson"
+		with records_path.open("w") as fo:
+			pstree.record_snapshots(fo, snapshots)
+		for at, expected_pids in [
+			("2024-01-01T12:00:00.500", [1, 10, 11]),
+			("2024-01-01T12:00:01.500", [1, 10, 12]),
+			("2024-01-01T12:00:05", [1, 12, 13]),
+		]:
+			output = io.StringIO()
+			with contextlib.redirect_stdout(output):
+				pstree.main(args=["--replay", str(records_path), "--at", at], prog="pstree.py")
+			lines = re.sub(r"\x1b\[[\d;]*m", "", output.getvalue())
+			pids = [int(pid) for pid in re.findall(r"(\d+) \(PGID", lines)]
+			assert pids == expected_pids, (at, pids, expected_pids)
+
+
+def measure_stages(pstree, parse, *, repeat):
+	"""
+	Runs every stage `repeat` times and returns the best time of each, in seconds, and the number of filtered rows.
+	"""
+	best = {}
+
+	def measure(name, f):
+		begin = time.perf_counter()
+		result = f()
+		elapsed = time.perf_counter() - begin
+		best[name] = min(best.get(name, elapsed), elapsed)
+		return result
+
+	node_filter_args = dict(include_users=["alice"], exclude_commands=[r"\["])
+	for _ in range(repeat):
+		processes = measure("parse", parse)
+		trees = measure("build", lambda: list(pstree.build_process_trees(processes)))
+		node_filter = pstree.NodeFilter(**node_filter_args)
+		measure("filter", lambda: [t.compute_shown(node_filter) for t in trees])
+		measure("render", lambda: sum(1 for t in trees for _ in t.render_lines(max_width=120)))
+		filtered_rows = measure("render_filtered", lambda: sum(1 for t in trees for _ in t.render_lines(max_width=120, **node_filter_args)))
+		measure("rollups", lambda: [t.compute_rollups() for t in trees])
+	return best, filtered_rows
+
+
+USERS = ["root", "alice", "bob", "www-data", "postgres", "nobody"]
+SERVICES = [
+	["/usr/sbin/sshd -D", "sshd: alice [priv]", "sshd: alice@pts/0", "-bash", "vim notes.txt", "less /var/log/syslog"],
+	["/usr/bin/containerd", "/usr/bin/containerd-shim-runc-v2 -namespace moby", "/usr/local/bin/node server.js"],
+	["/usr/lib/postgresql/16/bin/postgres -D /var/lib/postgresql/16/main", "postgres: checkpointer", "postgres: walwriter"],
+	["nginx: master process /usr/sbin/nginx", "nginx: worker process"],
+	["/usr/bin/python3 -m gunicorn app:app", "/usr/bin/python3 -m gunicorn app:app --worker"],
+	["/usr/sbin/cron -f", "/bin/sh -c /usr/local/bin/backup.sh", "rsync -a /srv/ backup:/srv/"],
+]
+
+
+def generate_processes(count, *, seed):
+	"""
+	A process table shaped like a busy server: kernel threads under kthreadd and services under init, each service with
+	a few levels of workers. Returns dicts with pid, ppid, pgid, user, rss, cputime, threads, start and args.
+	"""
+	rng = random.Random(seed)
+	page_size_kb = os.sysconf("SC_PAGE_SIZE") // 1024
+	processes = [
+		dict(pid=1, ppid=0, pgid=1, user="root", args="/sbin/init", depth=0, service=None),
+		dict(pid=2, ppid=0, pgid=0, user="root", args="", comm="kthreadd", depth=0, service=None),
+	]
+	next_pid = 3
+	candidates = []
+	while len(processes) < count:
+		r = rng.random()
+		if r < 0.1:
+			parent = processes[1]
+			p = dict(ppid=2, pgid=0, user="root", args="", comm=f"kworker/{rng.randrange(64)}:{rng.randrange(4)}")
+		elif r < 0.15 or not candidates:
+			parent = processes[0]
+			service = rng.randrange(len(SERVICES))
+			p = dict(ppid=1, user=rng.choice(USERS), args=SERVICES[service][0], service=service)
+		else:
+			parent = rng.choice(candidates[-200:] if rng.random() < 0.7 else candidates)
+			commands = SERVICES[parent["service"]]
+			p = dict(
+				ppid=parent["pid"],
+				user=parent["user"] if rng.random() < 0.8 else rng.choice(USERS),
+				args=commands[min(parent["depth"], len(commands) - 1)] + f" --id={next_pid}",
+				service=parent["service"],
+			)
+		p["pid"] = next_pid
+		p["depth"] = parent["depth"] + 1
+		p.setdefault("pgid", p["pid"] if rng.random() < 0.3 else parent.get("pgid", p["pid"]))
+		p.setdefault("service", None)
+		processes.append(p)
+		if p["service"] is not None and p["depth"] < 12:
+			candidates.append(p)
+		next_pid += rng.randint(1, 5)
+
+	for p in processes:
+		p["rss"] = 0 if not p["args"] else rng.randint(500, 2_000_000) // page_size_kb * page_size_kb
+		p["cputime"] = rng.randint(0, 360_000)
+		p["threads"] = rng.choice([1, 1, 1, 2, 4, 16])
+		p["start"] = rng.randint(0, 86_400 * 30)
+	return processes
+
+
+def format_ps_output(pstree, processes):
+	"""
+	Formats the processes the way `ps` does for the arguments pstree.py passes to it.
+	"""
+	columns = [arg[2:].split("=", 1) for arg in pstree.ps_command(with_lstart=True)[2:]]
+	boot_time = time.time() - 86_400 * 31
+
+	def format_duration(seconds):
+		days, seconds = divmod(seconds, 86_400)
+		hours, seconds = divmod(seconds, 3600)
+		minutes, seconds = divmod(seconds, 60)
+		return (f"{days}-" if days else "") + f"{hours:02}:{minutes:02}:{seconds:02}"
+
+	values = {
+		"pid": lambda p: str(p["pid"]),
+		"ppid": lambda p: str(p["ppid"]),
+		"pgid": lambda p: str(p["pgid"]),
+		"user": lambda p: p["user"],
+		"etime": lambda p: format_duration(86_400 * 31 - p["start"]),
+		"time": lambda p: format_duration(p["cputime"] // 100),
+		"rss": lambda p: str(p["rss"]),
+		"lstart": lambda p: time.strftime("%c", time.localtime(boot_time + p["start"])),
+		"args": lambda p: p["args"] or "[{}]".format(p["comm"]),
+	}
+	rows = [[header for kw, header in columns]]
+	rows.extend([values[kw](p) for kw, header in columns] for p in processes)
+	widths = [max(len(row[i]) for row in rows) for i in range(len(columns) - 1)]
+	lines = []
+	for row in rows:
+		cells = [
+			v.rjust(w) if kw in ("pid", "ppid", "pgid", "rss") else v.ljust(w)
+				for v, w, (kw, header) in zip(row, widths, columns)
+		]
+		lines.append(" ".join([*cells, row[-1]]))
+	return "\n".join(lines).encode()
+
+
+def write_procfs(root, processes):
+	"""
+	Writes the subset of /proc files that pstree.py reads. The users of processes are the owners of their directories,
+	which only root can change.
+	"""
+	boot_time = int(time.time()) - 86_400 * 31
+	clock_ticks = os.sysconf("SC_CLK_TCK")
+	page_size_kb = os.sysconf("SC_PAGE_SIZE") // 1024
+	root.joinpath("stat").write_text(f"cpu  0 0 0 0 0 0 0 0 0 0\nbtime {boot_time}\n")
+	uids = {user: i for i, user in enumerate(USERS)}
+	for p in processes:
+		proc_dir = root / str(p["pid"])
+		proc_dir.mkdir()
+		comm = p.get("comm") or pathlib.PurePath(p["args"].split()[0]).name
+		utime = p["cputime"] * 2 // 3
+		stat = [
+			"S", p["ppid"], p["pgid"], 0, 0, -1, 4194560, 0, 0, 0, 0,
+			utime, p["cputime"] - utime, 0, 0, 20, 0, p["threads"], 0, p["start"] * clock_ticks,
+			p["rss"] * 4096, p["rss"] // page_size_kb,
+		]
+		proc_dir.joinpath("stat").write_text(f"{p['pid']} ({comm}) " + " ".join(str(v) for v in stat) + "\n")
+		proc_dir.joinpath("statm").write_text(f"{p['rss'] // page_size_kb * 4} {p['rss'] // page_size_kb} 0 0 0 0 0\n")
+		if os.geteuid() == 0:
+			os.chown(proc_dir, uids[p["user"]], uids[p["user"]])
+		proc_dir.joinpath("status").write_text(f"Name:\t{comm}\nThreads:\t{p['threads']}\n")
+		proc_dir.joinpath("cmdline").write_bytes(p["args"].replace(" ", "\0").encode() + (b"\0" if p["args"] else b""))
+
+
+def parse_args(*, args, prog):
+	parser = argparse.ArgumentParser(prog=prog, description=__doc__)
+	parser.add_argument(
+		"--size", "-s", dest="sizes", action="append", metavar="PROCESS_COUNT", type=int, default=[],
+		help="number of processes in a synthetic process table, can be used multiple times, default is 1000, 10000 and 100000"
+	)
+	parser.add_argument(
+		"--repeat", "-r", dest="repeat", action="store", metavar="COUNT", type=int, default=3,
+		help="run every stage this many times and report the best time"
+	)
+	parser.add_argument(
+		"--seed", dest="seed", action="store", metavar="NUMBER", type=int, default=0,
+		help="seed of the process table generator"
+	)
+	parser.add_argument(
+		"--output", "-o", dest="output", action="store", metavar="JSON_FILE_PATH", type=argparse.FileType("w"), default=sys.stdout,
+		help="where to write the results, stdout by default"
+	)
+	parser.add_argument(
+		"--check", dest="check", action="store_true", default=False,
+		help="instead of timing anything, check that replaying recorded snapshots shows the processes of the right ones"
+	)
+	opts = parser.parse_args(args)
+	opts.sizes = opts.sizes or [1_000, 10_000, 100_000]
+	return vars(opts)
+
+
+if __name__ == "__main__":
+	sys.exit(main(**parse_args(args=sys.argv[1:], prog=sys.argv[0])))
@@ -7,7 +7,8 @@
 # ]
 # ///
 
-import sys, argparse, locale, subprocess, os, datetime, time, collections, re, json, pathlib
+import sys, argparse, locale, subprocess, os, datetime, time, collections, re, json, pathlib, pwd, bisect, asyncio, shlex
+import concurrent.futures, functools, itertools
 
 
 def main(*, args, prog):
@@ -16,43 +17,139 @@ def main(*, args, prog):
 
 	ANSI_smcup = "\x1b[?1049h"
 	ANSI_rmcup = "\x1b[?1049l"
-	ANSI_clear = "\x1b[H\x1b[2J"
+	ANSI_bold  = "\x1b[1m"
 
 	max_width = os.get_terminal_size().columns if sys.stdout.isatty() else 0
 
-	def render():
-		return "\n".join(
-			p.render(
+	def render_lines(trees, *, include_commands=None, max_rows=None):
+		include_nodes = None
+		if opts.top:
+			trees = list(trees)
+			include_nodes = select_heaviest_subtrees(trees, count=opts.top, sort_key=opts.sort_key)
+		rows = 0
+		for i, p in enumerate(trees):
+			if i:
+				if max_rows is not None and rows + 1 >= max_rows:
+					break
+				yield "\n"
+				rows += 1
+			for line in p.render_lines(
 				include_pids=opts.include_pids,
 				exclude_pids=opts.exclude_pids,
 				include_users=opts.include_users,
 				exclude_users=opts.exclude_users,
-				include_commands=opts.include_commands,
+				include_commands=include_commands if include_commands is not None else opts.include_commands,
 				exclude_commands=opts.exclude_commands,
-				max_width=max_width
-			)
-				for p in gen_process_trees()
-		)
+				include_nodes=include_nodes,
+				columns=opts.columns,
+				details_timeout=DETAILS_TIMEOUT if opts.watch else None,
+				min_age=opts.older_than,
+				max_age=opts.started_within,
+				order_by=opts.order_by,
+				max_width=max_width,
+				max_rows=max_rows - rows if max_rows is not None else None,
+			):
+				yield line
+				rows += 1
+
+	def write_trees(trees):
+		is_empty = True
+		for line in render_lines(trees):
+			sys.stdout.write(line)
+			is_empty = False
+		sys.stdout.flush()
+		return is_empty
+
+	async def show_hosts():
+		is_empty, has_output = True, False
+		hosts_trees = []
+		async for host, processes, error in gen_hosts_processes(
+			opts.hosts,
+			transport=opts.transport,
+			timeout=opts.timeout,
+			max_connections=opts.max_connections,
+		):
+			if error is not None:
+				print(f"{host}: {error}", file=sys.stderr)
+				continue
+			trees = list(build_process_trees(processes))
+			if opts.merge:
+				hosts_trees.append((host, trees))
+				continue
+			sys.stdout.write("{}{}{}{}\n".format("\n" if has_output else "", ANSI_bold, host, TreeNode.style_reset))
+			is_empty = write_trees(trees) and is_empty
+			has_output = True
+
+		# Merged view, the matching subtrees of all hosts grouped by the command pattern.
+		hosts_trees.sort(key=lambda host_and_trees: opts.hosts.index(host_and_trees[0]))
+		for pattern in (opts.include_commands if opts.merge else []):
+			sys.stdout.write("{}{}{}{}\n".format("\n" if has_output else "", ANSI_bold, pattern, TreeNode.style_reset))
+			has_output = True
+			for host, trees in hosts_trees:
+				lines = list(render_lines(trees, include_commands=[pattern]))
+				if all(l == "\n" for l in lines):
+					continue
+				sys.stdout.write("{}\n".format(host))
+				sys.stdout.writelines(lines)
+				is_empty = False
+		sys.stdout.flush()
+		return is_empty
+
+	def watch(snapshots):
+		nonlocal max_width
+		forest = ProcessForest()
+		screen = TerminalScreen(fo=sys.stdout)
+		try:
+			sys.stdout.write(ANSI_smcup)
+			for snapshot_time, processes in snapshots:
+				forest.update(processes)
+				max_rows = None
+				if sys.stdout.isatty():
+					max_width, max_rows = os.get_terminal_size()
+				# Only the rows that fit on the screen are rendered, and only their details are collected.
+				screen.update([
+					"{}".format(snapshot_time),
+					"",
+					*(l.rstrip("\n") for l in render_lines(forest.roots(), max_rows=max(max_rows - 2, 0) if max_rows else None)),
+				])
+		except KeyboardInterrupt:
+			pass
+		finally:
+			sys.stdout.write(ANSI_rmcup)
 
 	try:
-		if opts.watch:
-			try:
-				sys.stdout.write(ANSI_smcup)
-				while True:
-					s = render()
-					sys.stdout.write(ANSI_clear)
-					sys.stdout.write("{}\n\n".format(datetime.datetime.now()))
-					sys.stdout.write(s)
-					sys.stdout.flush()
-					time.sleep(opts.interval)
-			except KeyboardInterrupt:
-				pass
-			finally:
-				sys.stdout.write(ANSI_rmcup)
+		if opts.hosts:
+			return 1 if asyncio.run(show_hosts()) else 0
+		elif opts.replay:
+			with opts.replay.open("r") as fo:
+				if opts.replay_from is None and opts.replay_to is None:
+					snapshot = None
+					for snapshot in gen_recorded_snapshots(fo, until=opts.replay_at):
+						pass
+					if snapshot is None:
+						return 1
+					return 1 if write_trees(build_process_trees(gen_recorded_processes(*snapshot))) else 0
+				snapshots = (
+					(t, records) for t, records in gen_recorded_snapshots(fo, until=opts.replay_to)
+						if opts.replay_from is None or t >= opts.replay_from
+				)
+				snapshots = ((t, list(gen_recorded_processes(t, records))) for t, records in snapshots)
+				if sys.stdout.isatty():
+					watch(gen_paced(snapshots, interval=opts.interval))
+				else:
+					for i, (t, processes) in enumerate(snapshots):
+						sys.stdout.write("{}{}\n\n".format("\n" if i else "", t))
+						write_trees(build_process_trees(processes))
+		elif opts.record:
+			with opts.record.open("a") as fo:
+				try:
+					record_snapshots(fo, gen_live_snapshots(interval=opts.interval))
+				except KeyboardInterrupt:
+					pass
+		elif opts.watch:
+			watch(gen_live_snapshots(interval=opts.interval))
 		else:
-			output = render()
-			sys.stdout.write(output)
-			return 0 if output else 1
+			return 1 if write_trees(gen_process_trees()) else 0
 	except subprocess.CalledProcessError as e:
 		print(
 			"Command Failed with exit code ", e.returncode, "\n",
@@ -68,6 +165,8 @@ def main(*, args, prog):
 
 
 FIELD_NAME_PADDING = ("{", "}")
+PROCFS_ROOT = pathlib.Path("/proc")
+CONTROL_CHARS_PATTERN = re.compile(r"[\x00-\x1f\x7f]")
 
 
 def encode_field_name(name):
@@ -76,29 +175,119 @@ def encode_field_name(name):
 
 
 def gen_process_trees():
+	yield from build_process_trees(gen_processes())
+
+
+def gen_live_snapshots(*, interval):
+	while True:
+		yield datetime.datetime.now(), list(gen_processes())
+		time.sleep(interval)
+
+
+def gen_paced(snapshots, *, interval):
+	for i, snapshot in enumerate(snapshots):
+		if i:
+			time.sleep(interval)
+		yield snapshot
+
+
+def gen_processes():
+	if sys.platform.startswith("linux") and PROCFS_ROOT.joinpath("self", "stat").exists():
+		return gen_processes_procfs()
+	else:
+		return gen_processes_ps()
+
+
+def build_process_trees(processes):
+	tree_nodes = collections.defaultdict(TreeNode)
+	for p in processes:
+		pid, ppid = int(p["pid"]), int(p["ppid"])
+		node = tree_nodes[pid]
+		node.data = p
+		if ppid != pid:
+			parent = tree_nodes[ppid]
+			if parent.is_blank():
+				parent.data = {"pid": ppid}
+			parent.children.append(node)
+			node.parent = parent
+
+	yield from (n for n in tree_nodes.values() if n.parent is None)
+
+
+def ps_command(*, with_lstart=True):
 	fields = [
 		("pid", "pid"),
 		("ppid", "ppid"),
 		("pgid", "pgid"),
 		("user", "user"),
 		("etime", "etime"),
+		("cputime", "time"),
 		("rss", "rss"),
 		("args", "args") # must be last
 	]
-	ps_args = []
-	if "sunos" not in sys.platform:
+	if with_lstart:
 		fields.insert(-1, ("lstart", "lstart"))
-	ps_args.extend(f"-o{kw}={encode_field_name(name)}" for name, kw in fields)
+	return ["ps", "-e", *(f"-o{kw}={encode_field_name(name)}" for name, kw in fields)]
+
+
+def gen_processes_ps():
 	ps_kwargs = dict(shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	with subprocess.Popen(["ps", "-e", *ps_args], **ps_kwargs) as p:
+	with subprocess.Popen(ps_command(with_lstart="sunos" not in sys.platform), **ps_kwargs) as p:
 		ps_pid = p.pid
 		stdout, stderr = p.communicate()
+		snapshot_time = datetime.datetime.now()
 		retcode = p.wait()
 		if retcode:
 			raise subprocess.CalledProcessError(retcode, p.args, output=stdout, stderr=stderr)
 		assert not stderr, stderr
-		lines = stdout.decode().splitlines()
-		max_width = max(len(l) for l in lines)
+	for p in gen_resolved_start_times(parse_ps_output(stdout), snapshot_time=snapshot_time):
+		if int(p["pid"]) == ps_pid:
+			continue
+		yield p
+
+
+def gen_resolved_start_times(processes, *, snapshot_time):
+	"""
+	Converts `lstart` of all processes of a snapshot to datetime, or derives it from `etime` when there is no `lstart`,
+	and recalculates `etime` from it, all relative to the same `snapshot_time`.
+	"""
+	for p in processes:
+		lstart = p.get("lstart")
+		if lstart:
+			p["lstart"] = parse_lstart(lstart)
+		else:
+			etime = parse_ps_duration(p.get("etime"))
+			p["lstart"] = snapshot_time - etime if etime is not None else None
+		if p["lstart"] is not None:
+			p["etime"] = snapshot_time - p["lstart"]
+		yield p
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_lstart(lstart):
+	# Most processes were started during boot or by the same few services, so there are far fewer distinct values than
+	# processes.
+	return datetime.datetime.strptime(lstart, "%c")
+
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+
+def parse_duration(s):
+	"""
+	Parses durations such as "90s", "5m" or "1h30m".
+	"""
+	parts = re.findall(r"(\d+(?:\.\d+)?)([smhdw])", s)
+	if not parts or "".join(n + u for n, u in parts) != s:
+		raise argparse.ArgumentTypeError(f"invalid duration: {s!r}, expected a number followed by one of: {', '.join(DURATION_UNITS)}")
+	return datetime.timedelta(seconds=sum(float(n) * DURATION_UNITS[u] for n, u in parts))
+
+
+def parse_ps_output(stdout):
+	lines = stdout.decode().splitlines()
+	if not lines:
+		return
+	max_width = max(len(l) for l in lines)
 
 	def is_column_separator(offset):
 		for l in lines:
@@ -122,23 +311,511 @@ def gen_process_trees():
 	#TODO:vruyr:bugs The padding string FIELD_NAME_PADDING is a sequence, not a set of chars. Also the padding must be stripped only from header.
 	lines = [[l[begin:end].strip().lstrip(FIELD_NAME_PADDING[0]).rstrip(FIELD_NAME_PADDING[1]) for begin, end in columns] for l in lines]
 	header = lines.pop(0)
-	processes = [tuple((header[i], v) for i, v in enumerate(l)) for l in lines]
+	for l in lines:
+		yield dict(zip(header, l))
 
-	tree_nodes = collections.defaultdict(TreeNode)
-	for p in (dict(p) for p in processes):
-		pid, ppid = p["pid"], p["ppid"]
-		if int(pid) == ps_pid:
+
+HOST_TRANSPORTS = {
+	"ssh": lambda host, script: ["ssh", "-o", "BatchMode=yes", host, script],
+	"local": lambda host, script: ["sh", "-c", script], # runs `ps` locally for every host, for testing without ssh
+}
+
+
+async def gen_hosts_processes(hosts, *, transport="ssh", timeout=None, max_connections=16):
+	"""
+	Runs `ps` on all hosts concurrently, at most `max_connections` at a time, and yields `(host, processes, error)` for
+	each host as soon as it is done. A host that fails or doesn't finish in `timeout` seconds is reported with an error
+	message instead of processes.
+	"""
+	# `lstart` is in the local time and locale of the remote host, the start time is derived from `etime` instead.
+	# The shell that ssh starts prints its pid and becomes `ps`, which is then left out the same way `gen_processes_ps`
+	# leaves out its own `ps`.
+	script = "echo $$; exec " + shlex.join(ps_command(with_lstart=False))
+	command = HOST_TRANSPORTS[transport]
+	semaphore = asyncio.Semaphore(max_connections)
+
+	async def collect(host):
+		async with semaphore:
+			try:
+				p = await asyncio.create_subprocess_exec(
+					*command(host, script),
+					stdin=subprocess.DEVNULL,
+					stdout=subprocess.PIPE,
+					stderr=subprocess.PIPE,
+				)
+			except OSError as e:
+				return host, None, str(e)
+			try:
+				stdout, stderr = await asyncio.wait_for(p.communicate(), timeout)
+				snapshot_time = datetime.datetime.now()
+			except TimeoutError:
+				p.kill()
+				await p.wait()
+				return host, None, f"timed out after {timeout} seconds"
+			if p.returncode:
+				return host, None, f"exit code {p.returncode}: {stderr.decode(errors='replace').strip()}"
+			try:
+				ps_pid, stdout = stdout.split(b"\n", 1)
+				ps_pid = int(ps_pid)
+				processes = list(gen_resolved_start_times(parse_ps_output(stdout), snapshot_time=snapshot_time))
+				for p in processes:
+					p["pid"], p["ppid"] = int(p["pid"]), int(p["ppid"])
+				processes = [p for p in processes if p["pid"] != ps_pid]
+			except Exception as e:
+				return host, None, f"unexpected output of ps: {e!r}"
+			return host, processes, None
+
+	for result in asyncio.as_completed([collect(host) for host in hosts]):
+		yield await result
+
+
+def get_user_name(uid):
+	try:
+		return pwd.getpwuid(uid).pw_name
+	except KeyError:
+		return str(uid)
+
+
+def gen_processes_procfs(*, root=None, lookup_user=get_user_name):
+	# https://man7.org/linux/man-pages/man5/proc_pid_stat.5.html
+	root = root or PROCFS_ROOT
+	clock_ticks = os.sysconf("SC_CLK_TCK")
+	page_size_kb = os.sysconf("SC_PAGE_SIZE") // 1024
+	boot_time = None
+	with root.joinpath("stat").open("rb") as fo:
+		for line in fo:
+			if line.startswith(b"btime "):
+				boot_time = datetime.datetime.fromtimestamp(int(line.split()[1]))
+				break
+	assert boot_time is not None, root
+	now = datetime.datetime.now()
+	users = {}
+
+	pids = sorted(int(name) for name in os.listdir(root) if name.isdigit())
+	for pid in pids:
+		proc_dir = root / str(pid)
+		try:
+			# The directory is owned by the effective uid of the process, same as `ps -o user`.
+			uid = os.stat(proc_dir).st_uid
+			stat = proc_dir.joinpath("stat").read_bytes()
+			statm = proc_dir.joinpath("statm").read_bytes()
+			cmdline = proc_dir.joinpath("cmdline").read_bytes()
+		except (FileNotFoundError, ProcessLookupError):
+			# The process exited while we were reading it.
 			continue
-		node = tree_nodes[pid]
-		node.data = p
-		if ppid != pid:
-			parent = tree_nodes[ppid]
-			if parent.is_blank():
-				parent.data = {"pid": ppid}
-			parent.children.append(node)
-			node.parent = parent
 
-	yield from (n for n in tree_nodes.values() if n.parent is None)
+		# The command name is in parentheses and can contain anything, including spaces and parentheses.
+		comm_begin, comm_end = stat.index(b"("), stat.rindex(b")")
+		comm = stat[comm_begin + 1:comm_end].decode(errors="replace")
+		stat_fields = stat[comm_end + 2:].split()
+		ppid, pgid = int(stat_fields[1]), int(stat_fields[2])
+		start_time = boot_time + datetime.timedelta(seconds=int(stat_fields[19]) / clock_ticks)
+		cputime = datetime.timedelta(seconds=(int(stat_fields[11]) + int(stat_fields[12])) / clock_ticks)
+
+		if uid not in users:
+			users[uid] = lookup_user(uid)
+
+		args = cmdline.rstrip(b"\0").replace(b"\0", b" ").decode(errors="replace")
+		args = CONTROL_CHARS_PATTERN.sub("?", args) # same as `ps`, keeps every process on its own line
+
+		yield {
+			"pid": pid,
+			"ppid": ppid,
+			"pgid": pgid,
+			"user": users[uid],
+			"etime": now - start_time,
+			"cputime": cputime,
+			"threads": int(stat_fields[17]),
+			"rss": str(int(statm.split()[1]) * page_size_kb),
+			"lstart": start_time,
+			"args": args or f"[{comm}]",
+		}
+
+
+def parse_ps_duration(s):
+	if not isinstance(s, str):
+		return s
+	m = re.match(r"^(?:(\d+)-)?(?:(\d+):)?(?:(\d+):)?(\d+(?:\.\d+)?)$", s)
+	if m is None:
+		return None
+	days, hours, minutes = (int(x or 0) for x in m.groups()[:3])
+	return datetime.timedelta(
+		days=days,
+		hours=hours,
+		minutes=minutes,
+		seconds=float(m.group(4)),
+	)
+
+
+def read_fd_count(pid):
+	return len(os.listdir(PROCFS_ROOT / str(pid) / "fd"))
+
+
+def read_cgroup(pid):
+	# The unified (v2) hierarchy is listed as "0::/path", with v1 the first controller's path is used.
+	lines = PROCFS_ROOT.joinpath(str(pid), "cgroup").read_text().splitlines()
+	paths = dict(l.split(":", 2)[::2] for l in lines)
+	return paths.get("0") or (lines[0].split(":", 2)[2] if lines else "-")
+
+
+def read_io(pid):
+	io = dict(l.split(": ", 1) for l in PROCFS_ROOT.joinpath(str(pid), "io").read_text().splitlines())
+	return "{}/{}".format(io["read_bytes"], io["write_bytes"])
+
+
+def read_status_field(name):
+	def read(pid):
+		for line in PROCFS_ROOT.joinpath(str(pid), "status").read_text().splitlines():
+			if line.startswith(name + ":"):
+				return line.split(":", 1)[1].strip()
+		return "-"
+	return read
+
+
+def read_detail_or_placeholder(read):
+	def read_detail(pid):
+		try:
+			return read(pid)
+		except (FileNotFoundError, ProcessLookupError):
+			return "-"
+		except PermissionError:
+			return "?"
+	return read_detail
+
+
+DETAIL_COLUMNS = {
+	"fds": read_detail_or_placeholder(read_fd_count),
+	"threads": read_detail_or_placeholder(read_status_field("Threads")),
+	"cgroup": read_detail_or_placeholder(read_cgroup),
+	"io": read_detail_or_placeholder(read_io),
+	"ctxsw": read_detail_or_placeholder(read_status_field("voluntary_ctxt_switches")),
+}
+DETAILS_MAX_WORKERS = 4
+DETAILS_TIMEOUT = 0.5
+DETAILS_MAX_AGE = 5.0
+_details_executor = None
+
+
+def get_details_executor():
+	global _details_executor
+	if _details_executor is None:
+		_details_executor = concurrent.futures.ThreadPoolExecutor(max_workers=DETAILS_MAX_WORKERS)
+	return _details_executor
+
+
+RECORD_FIELDS = ("pid", "ppid", "pgid", "user", "rss", "cputime", "threads", "start_time", "args")
+
+
+def record_snapshots(fo, snapshots):
+	"""
+	Appends snapshots to `fo` as NDJSON, one line per snapshot. The first line is a keyframe with all processes, after it
+	only processes that were spawned or changed (`set`) and pids that exited (`del`) are written. Every process is a list
+	of RECORD_FIELDS values.
+	"""
+	previous = None
+	for snapshot_time, processes in snapshots:
+		current = {}
+		for p in processes:
+			node = TreeNode(data=p)
+			current[node.pid] = [
+				node.pid,
+				node.ppid,
+				node.pgid,
+				node.user,
+				int(node.rss) if node.rss else None,
+				round(node.cputime.total_seconds(), 2) if node.cputime is not None else None,
+				node.threads,
+				round(node.start_time.timestamp()),
+				node.args,
+			]
+		if previous is None:
+			entry = {"t": snapshot_time.timestamp(), "fields": RECORD_FIELDS, "set": list(current.values())}
+		else:
+			entry = {
+				"t": snapshot_time.timestamp(),
+				"set": [r for pid, r in current.items() if previous.get(pid) != r],
+				"del": [pid for pid in previous if pid not in current],
+			}
+		fo.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+		fo.write("\n")
+		fo.flush()
+		previous = current
+
+
+def gen_recorded_snapshots(fo, *, until=None):
+	"""
+	Yields the time and the records of all processes, by pid, of every snapshot written by `record_snapshots` up to the
+	time `until`. The records are updated in place by the following snapshot, the last one yielded stays as it is.
+	"""
+	records = {}
+	for line in fo:
+		entry = json.loads(line)
+		if until is not None and datetime.datetime.fromtimestamp(entry["t"]) > until:
+			break
+		if "fields" in entry:
+			assert tuple(entry["fields"]) == RECORD_FIELDS, entry["fields"]
+			records = {}
+		for pid in entry.get("del", ()):
+			del records[pid]
+		for r in entry["set"]:
+			records[r[0]] = r
+		yield datetime.datetime.fromtimestamp(entry["t"]), records
+
+
+def gen_recorded_processes(snapshot_time, records):
+	for pid in sorted(records):
+		p = dict(zip(RECORD_FIELDS, records[pid]))
+		start_time = datetime.datetime.fromtimestamp(p.pop("start_time"))
+		p["lstart"] = start_time
+		p["etime"] = snapshot_time - start_time
+		p["rss"] = str(p["rss"]) if p["rss"] is not None else None
+		p["cputime"] = datetime.timedelta(seconds=p["cputime"]) if p["cputime"] is not None else None
+		yield p
+
+
+SubtreeRollup = collections.namedtuple("SubtreeRollup", ["rss", "cputime", "threads", "count"])
+
+
+ROLLUP_SORT_KEYS = {
+	"rss": lambda r: r.rss,
+	"cpu": lambda r: r.cputime,
+	"count": lambda r: r.count,
+}
+
+
+def select_heaviest_subtrees(roots, *, count, sort_key):
+	"""
+	Finds the `count` heaviest subtrees by repeatedly splitting the heaviest one into its children until there are enough
+	of them, e.g. the tree under init is split into per-service subtrees. Returns them along with their heavy branches -
+	the descendants carrying at least 1/`count` of the subtree total.
+	"""
+	weight = lambda node: ROLLUP_SORT_KEYS[sort_key](node.rollup)
+	is_alive = lambda node: node.churn != "exited"
+	for root in roots:
+		root.compute_rollups()
+
+	subtrees = sorted(filter(is_alive, roots), key=weight, reverse=True)
+	while len(subtrees) < count:
+		for i, node in enumerate(subtrees):
+			if node.has_children():
+				break
+		else:
+			break
+		subtrees = sorted([*subtrees[:i], *filter(is_alive, node.children), *subtrees[i + 1:]], key=weight, reverse=True)
+	subtrees = subtrees[:count]
+
+	selected = set()
+	for subtree in subtrees:
+		threshold = weight(subtree) / count
+		stack = [subtree]
+		while stack:
+			node = stack.pop()
+			selected.add(node)
+			stack.extend(c for c in node.children if weight(c) and weight(c) >= threshold)
+	return selected
+
+
+PROCESS_IDENTITY_FIELDS = ("ppid", "user", "args", "lstart")
+
+
+class ProcessForest(object):
+	"""
+	Process trees that are kept between `--watch` ticks and updated in place with only the pids that were spawned, exited,
+	reparented or changed since the previous snapshot. Nodes of processes that exited stay in the tree for one tick so
+	that they can be shown.
+	"""
+
+	def __init__(self):
+		self.nodes = {}
+
+	def roots(self):
+		return sorted((n for n in self.nodes.values() if n.parent is None), key=lambda n: n.pid)
+
+	def update(self, processes):
+		for pid in [pid for pid, node in self.nodes.items() if node.churn == "exited"]:
+			self._remove(self.nodes[pid])
+
+		is_first_snapshot = not self.nodes
+		spawned, seen = set(), set()
+		for p in processes:
+			pid, ppid = int(p["pid"]), int(p["ppid"])
+			seen.add(pid)
+			node = self.nodes.get(pid)
+			if node is None:
+				node = self.nodes[pid] = TreeNode()
+				node.data = p
+				if not is_first_snapshot:
+					node.churn = "spawned"
+					spawned.add(pid)
+			else:
+				if node.data != p:
+					# `etime`, cpu time and rss change every tick, the details are kept as long as it is the same process.
+					is_same_process = all(node.get_field(k) == p.get(k) for k in PROCESS_IDENTITY_FIELDS)
+					node.data = p
+					node._field_cache = {
+						k: v for k, v in node._field_cache.items()
+							if isinstance(k, tuple) and (is_same_process or not v[1].done())
+					}
+				if node.churn == "placeholder" and not is_first_snapshot:
+					spawned.add(pid)
+				node.churn = "spawned" if pid in spawned else None
+			parent = node.parent
+			if ppid == pid:
+				if parent is not None:
+					self._detach(node)
+			elif parent is None or parent.pid != ppid:
+				if parent is not None:
+					self._detach(node)
+				self._attach(node, ppid)
+
+		exited = set()
+		for pid, node in list(self.nodes.items()):
+			if pid in seen:
+				continue
+			if node.churn == "placeholder":
+				if not node.has_children():
+					self._remove(node)
+				continue
+			node.churn = "exited"
+			exited.add(pid)
+
+		return spawned, exited
+
+	def _attach(self, node, ppid):
+		parent = self.nodes.get(ppid)
+		if parent is None:
+			parent = self.nodes[ppid] = TreeNode()
+			parent.data = {"pid": ppid}
+			parent.churn = "placeholder"
+		bisect.insort(parent.children, node, key=lambda n: n.pid)
+		node.parent = parent
+
+	def _detach(self, node):
+		node.parent.children.remove(node)
+		node.parent = None
+
+	def _remove(self, node):
+		if node.parent is not None:
+			self._detach(node)
+		for child in list(node.children):
+			self._detach(child)
+		del self.nodes[node.pid]
+
+
+class TerminalScreen(object):
+	"""
+	Keeps the rows that are currently on the screen and rewrites only the ones that have changed.
+	"""
+
+	def __init__(self, *, fo):
+		self.fo = fo
+		self.rows = []
+		self.size = None
+
+	def update(self, rows):
+		size = os.get_terminal_size() if self.fo.isatty() else None
+		if size is not None:
+			rows = rows[:size.lines]
+		if size != self.size:
+			self.fo.write("\x1b[H\x1b[2J")
+			self.rows = []
+			self.size = size
+		for i, row in enumerate(rows):
+			if i < len(self.rows) and self.rows[i] == row:
+				continue
+			self.fo.write(f"\x1b[{i + 1};1H{row}\x1b[K")
+		if len(rows) < len(self.rows):
+			self.fo.write(f"\x1b[{len(rows) + 1};1H\x1b[J")
+		self.fo.flush()
+		self.rows = rows
+
+
+class NodeFilter(object):
+	"""
+	Include and exclude criteria of a rendering, with patterns compiled once for all nodes.
+	"""
+
+	__slots__ = (
+		"include_pids", "exclude_pids", "include_users", "exclude_users", "include_commands", "exclude_commands",
+		"include_nodes", "min_age", "max_age",
+	)
+
+	def __init__(self, *,
+		include_pids=None,
+		exclude_pids=None,
+		include_users=None,
+		exclude_users=None,
+		include_commands=None,
+		exclude_commands=None,
+		include_nodes=None,
+		min_age=None,
+		max_age=None,
+	):
+		self.include_pids = frozenset(include_pids) if include_pids else None
+		self.exclude_pids = frozenset(exclude_pids) if exclude_pids else None
+		self.include_users = frozenset(include_users) if include_users else None
+		self.exclude_users = frozenset(exclude_users) if exclude_users else None
+		self.include_commands = [re.compile(r) for r in include_commands] if include_commands else None
+		self.exclude_commands = [re.compile(r) for r in exclude_commands] if exclude_commands else None
+		self.include_nodes = include_nodes
+		self.min_age = min_age
+		self.max_age = max_age
+
+	def is_empty(self):
+		return not (
+			self.include_pids or self.exclude_pids or
+			self.include_users or self.exclude_users or
+			self.include_commands or self.exclude_commands or
+			self.include_nodes is not None or
+			self.min_age is not None or self.max_age is not None
+		)
+
+	def is_pruned(self, node):
+		return self.exclude_pids is not None and node.pid in self.exclude_pids
+
+	def unfilters_descendants(self, node):
+		return self.include_pids is not None and node.pid in self.include_pids
+
+	def is_explicitly_included(self, node):
+		if self.include_nodes is not None and node not in self.include_nodes:
+			return False
+		if self.min_age is not None or self.max_age is not None:
+			# Ages are relative to the time of the snapshot, not to the time of rendering.
+			age = node.etime
+			if age is None:
+				return False
+			if self.min_age is not None and age < self.min_age:
+				return False
+			if self.max_age is not None and age > self.max_age:
+				return False
+		is_included = (
+			(not (self.include_pids or self.include_users or self.include_commands)) or
+			(self.include_pids is not None and node.pid in self.include_pids) or
+			(self.include_users is not None and node.user in self.include_users) or
+			(self.include_commands is not None and self.matches_one_of_patterns(node.args, self.include_commands))
+		)
+		if not is_included:
+			return False
+		is_excluded = (
+			(self.exclude_users is not None and node.user in self.exclude_users) or
+			(self.exclude_commands is not None and self.matches_one_of_patterns(node.args, self.exclude_commands))
+		)
+		return not is_excluded
+
+	@staticmethod
+	def matches_one_of_patterns(s, patterns):
+		if s is None:
+			return False
+		for p in patterns:
+			if p.match(s):
+				return True
+		return False
+
+
+NODE_ORDER_KEYS = {
+	"pid": lambda n: n.pid,
+	"start": lambda n: (n.start_time, n.pid),
+}
 
 
 class AnsiEscapeCode(str):
@@ -146,7 +823,7 @@ class AnsiEscapeCode(str):
 
 
 class TreeNode(object):
-	__slots__ = ("data", "parent", "children", "_field_cache")
+	__slots__ = ("data", "parent", "children", "churn", "rollup", "_field_cache")
 
 	indent = 4
 	vertical = "│├└"
@@ -155,12 +832,18 @@ class TreeNode(object):
 	style_pid   = "\x1b[2;35m"
 	style_pgid  = "\x1b[2;34m"
 	style_cmd   = "\x1b[37m"
+	style_spawned = "\x1b[1;32m"
+	style_exited  = "\x1b[9;31m"
+	style_rollup  = "\x1b[2;33m"
+	style_details = "\x1b[2;36m"
 	style_reset = "\x1b[0m"
 
 	def __init__(self, *, data=None):
-		self.data = None
+		self.data = data
 		self.parent = None
 		self.children = []
+		self.churn = None
+		self.rollup = None
 		self._field_cache = {}
 
 	def __str__(self):
@@ -173,6 +856,10 @@ class TreeNode(object):
 	def is_blank(self):
 		return not self.data
 
+	@property
+	def churn_style(self):
+		return self.churn if self.churn in ("spawned", "exited") else None
+
 	def has_children(self):
 		return len(self.children) > 0
 
@@ -182,20 +869,19 @@ class TreeNode(object):
 	@property
 	def etime(self):
 		if "etime" not in self._field_cache:
-			etime = self.get_field("etime")
-			m = re.match(r"^(?:(\d+)-)?(?:(\d+):)?(?:(\d+):)?(?:(\d+))$", etime)
-			if m is not None:
-				days, hours, minutes, seconds = (int(x or 0) for x in m.groups())
-				self._field_cache["etime"] = datetime.timedelta(
-					days=days,
-					hours=hours,
-					minutes=minutes,
-					seconds=seconds,
-				)
-			else:
-				self._field_cache["etime"] = None
+			self._field_cache["etime"] = parse_ps_duration(self.get_field("etime"))
 		return self._field_cache["etime"]
 
+	@property
+	def cputime(self):
+		if "cputime" not in self._field_cache:
+			self._field_cache["cputime"] = parse_ps_duration(self.get_field("cputime"))
+		return self._field_cache["cputime"]
+
+	@property
+	def threads(self):
+		return self.get_field("threads")
+
 	@property
 	def rss(self):
 		return self.get_field("rss")
@@ -204,11 +890,10 @@ class TreeNode(object):
 	def start_time(self):
 		if "lstart" not in self._field_cache:
 			lstart = self.get_field("lstart")
-			if lstart is not None:
-				self._field_cache["lstart"] = datetime.datetime.strptime(lstart, "%c")
-			elif self.etime is not None:
-				#TODO:vruyr:bugs Relative time should be calculated from a single point - the `ps` process.
-				self._field_cache["lstart"] = datetime.datetime.now() - self.etime
+			if isinstance(lstart, datetime.datetime):
+				self._field_cache["lstart"] = lstart
+			elif lstart is not None:
+				self._field_cache["lstart"] = parse_lstart(lstart)
 			else:
 				self._field_cache["lstart"] = datetime.datetime.fromtimestamp(0)
 		return self._field_cache["lstart"]
@@ -251,8 +936,48 @@ class TreeNode(object):
 		exclude_users=None,
 		include_commands=None,
 		exclude_commands=None,
+		include_nodes=None,
+		columns=None,
+		details_timeout=None,
+		min_age=None,
+		max_age=None,
+		order_by=None,
+		max_rows=None,
 	):
-		result = ""
+		return "".join(self.render_lines(
+			max_width=max_width,
+			include_pids=include_pids,
+			exclude_pids=exclude_pids,
+			include_users=include_users,
+			exclude_users=exclude_users,
+			include_commands=include_commands,
+			exclude_commands=exclude_commands,
+			include_nodes=include_nodes,
+			columns=columns,
+			details_timeout=details_timeout,
+			min_age=min_age,
+			max_age=max_age,
+			order_by=order_by,
+			max_rows=max_rows,
+		))
+
+	def render_lines(self, *,
+		max_width=None,
+		include_pids=None,
+		exclude_pids=None,
+		include_users=None,
+		exclude_users=None,
+		include_commands=None,
+		exclude_commands=None,
+		include_nodes=None,
+		columns=None,
+		details_timeout=None,
+		min_age=None,
+		max_age=None,
+		order_by=None,
+		max_rows=None,
+	):
+		line = []
 		width = max_width
 		for piece in self.render_gen(
 			include_pids=include_pids,
@@ -260,18 +985,71 @@ class TreeNode(object):
 			include_users=include_users,
 			exclude_users=exclude_users,
 			include_commands=include_commands,
-			exclude_commands=exclude_commands
+			exclude_commands=exclude_commands,
+			include_nodes=include_nodes,
+			columns=columns,
+			details_timeout=details_timeout,
+			min_age=min_age,
+			max_age=max_age,
+			order_by=order_by,
+			max_rows=max_rows,
 		):
-			if isinstance(piece, AnsiEscapeCode) or not max_width:
-				result += str(piece)
-			elif piece == "\n":
+			if piece == "\n":
+				line.append(piece)
+				yield "".join(line)
+				line.clear()
 				width = max_width
-				result += piece
+			elif isinstance(piece, AnsiEscapeCode) or not max_width:
+				line.append(str(piece))
 			else:
 				piece = str(piece)
-				result += piece[:width]
+				line.append(piece[:max(width, 0)])
 				width -= len(piece)
-		return result
+		if line:
+			yield "".join(line)
+
+	def request_details(self, columns):
+		now = time.monotonic()
+		for name in columns:
+			requested = self._field_cache.get(("detail", name))
+			if requested is None or (requested[1].done() and now - requested[0] > DETAILS_MAX_AGE):
+				self._field_cache[("detail", name)] = (now, get_details_executor().submit(DETAIL_COLUMNS[name], self.pid))
+
+	def get_detail(self, name, *, deadline=None):
+		requested = self._field_cache.get(("detail", name))
+		if requested is None:
+			return "-"
+		future = requested[1]
+		try:
+			return future.result(timeout=max(deadline - time.monotonic(), 0) if deadline is not None else None)
+		except concurrent.futures.TimeoutError:
+			return "…"
+
+	def compute_rollups(self):
+		"""
+		Sums up rss, cpu time, thread and process counts of every subtree in one post-order pass, the results are in the
+		`rollup` attribute of each node.
+		"""
+		stack = [(self, False)]
+		while stack:
+			node, children_are_done = stack.pop()
+			if not children_are_done:
+				stack.append((node, True))
+				stack.extend((c, False) for c in node.children)
+				continue
+			# Processes that exited since the previous `--watch` tick are still shown, but no longer count.
+			is_process = node.ppid is not None and node.churn != "exited"
+			rss = int(node.rss) if node.rss and is_process else 0
+			cputime = node.cputime.total_seconds() if node.cputime and is_process else 0.0
+			threads = (node.threads or 1) if is_process else 0
+			count = 1 if is_process else 0
+			for c in node.children:
+				rss += c.rollup.rss
+				cputime += c.rollup.cputime
+				threads += c.rollup.threads
+				count += c.rollup.count
+			node.rollup = SubtreeRollup(rss=rss, cputime=cputime, threads=threads, count=count)
+		return self.rollup
 
 	def indent_self(self, *, has_parent, has_siblings_after, has_children):
 		if not has_parent:
@@ -289,15 +1067,6 @@ class TreeNode(object):
 			" " * (self.indent - 1)
 		)
 
-	@staticmethod
-	def matches_one_of_regexes(s, regexes):
-		if s is None:
-			return False
-		for r in regexes:
-			if re.match(r, s):
-				return True
-		return False
-
 	def render_gen(self, *,
 		include_pids=None,
 		exclude_pids=None,
@@ -305,85 +1074,96 @@ class TreeNode(object):
 		exclude_users=None,
 		include_commands=None,
 		exclude_commands=None,
+		include_nodes=None,
+		columns=None,
+		details_timeout=None,
+		min_age=None,
+		max_age=None,
+		order_by=None,
+		max_rows=None,
 		has_siblings_after=False,
 		_indent="",
 		_has_parent=False,
 	):
-		include_users = set(include_users) if include_users else include_users
+		node_filter = NodeFilter(
+			include_pids=include_pids,
+			exclude_pids=exclude_pids,
+			include_users=include_users,
+			exclude_users=exclude_users,
+			include_commands=include_commands,
+			exclude_commands=exclude_commands,
+			include_nodes=include_nodes,
+			min_age=min_age,
+			max_age=max_age,
+		)
 
-		if (
-			(exclude_pids and self.pid in exclude_pids)
-			# or
-			# (exclude_commands and self.matches_one_of_regexes(self.args, exclude_commands))
-		):
+		is_shown = self.compute_shown(node_filter)
+		if not node_filter.is_empty() and not is_shown[self]:
 			return
 
-		#TODO:vruyr:bugs Simplify the inclusion and exclusion selection logic.
-
-		def is_included():
-			return (
-				(not (include_pids or include_users or include_commands)) or
-				(include_pids and (self.pid in include_pids)) or
-				(include_users and (self.user in include_users)) or
-				(include_commands and self.matches_one_of_regexes(self.args, include_commands))
-			)
-
-		def is_excluded():
-			return (
-				(exclude_users and self.user in exclude_users) or
-				(exclude_commands and self.matches_one_of_regexes(self.args, exclude_commands))
-			)
+		# Top-down pass laying out the lines.
+		def gen_rows(has_siblings_after):
+			stack = [(self, not node_filter.is_empty(), has_siblings_after, _indent, _has_parent)]
+			while stack:
+				node, is_filtered, has_siblings_after, indent, has_parent = stack.pop()
+				children_are_filtered = is_filtered and not node_filter.unfilters_descendants(node)
+				children = [c for c in node.children if is_shown[c]] if children_are_filtered else node.children
+				if order_by is not None:
+					children = sorted(children, key=NODE_ORDER_KEYS[order_by])
+				yield node, indent, node.indent_self(has_parent=has_parent, has_siblings_after=has_siblings_after, has_children=bool(children))
+				child_indent = indent + node.indent_child(has_uncles_after=has_siblings_after) if has_parent else indent
+				stack.extend(
+					(c, children_are_filtered, i < len(children) - 1, child_indent, True)
+						for i, c in reversed(list(enumerate(children)))
+				)
 
-		explicitely_included = is_included() and not is_excluded()
-
-		if include_pids and self.pid in include_pids:
-			include_pids=None
-			exclude_pids=None
-			include_users=None
-			exclude_users=None
-			include_commands=None
-			exclude_commands=None
-
-		def render_child_gen(node, *, child_has_siblings_after):
-			yield from node.render_gen(
-				include_pids=include_pids,
-				exclude_pids=exclude_pids,
-				include_users=include_users,
-				exclude_users=exclude_users,
-				include_commands=include_commands,
-				exclude_commands=exclude_commands,
-				has_siblings_after=child_has_siblings_after,
-				_indent=(_indent + self.indent_child(has_uncles_after=has_siblings_after) if _has_parent else _indent),
-				_has_parent=True,
-			)
+		rows = gen_rows(has_siblings_after)
+		if max_rows is not None:
+			rows = itertools.islice(rows, max_rows)
+		details_deadline = None
+		if columns:
+			# Only the nodes that are actually shown get their details, all requested at once to be collected in parallel.
+			rows = list(rows)
+			for node, *_ in rows:
+				node.request_details(columns)
+			if details_timeout is not None:
+				details_deadline = time.monotonic() + details_timeout
 
-		def render_children():
-			renderings = []
-			for node in self.children:
-				r = list(render_child_gen(node, child_has_siblings_after=True))
-				if r:
-					renderings.append((node, r))
-			for n, r in renderings[:-1]:
-				yield from r
-			#TODO:vruyr:design Instead of re-rendering the last child, start from the end first
-			if renderings:
-				yield from render_child_gen(renderings[-1][0], child_has_siblings_after=False)
-
-		children_rendering = list(render_children())
-		if explicitely_included or children_rendering:
-			yield self.get_style("lines")
-			yield _indent
-			yield self.indent_self(has_parent=_has_parent, has_siblings_after=has_siblings_after, has_children=bool(children_rendering))
-			yield self.get_style("reset")
-			yield from self.render_self()
+		for node, indent, indent_self in rows:
+			yield node.get_style("lines")
+			yield indent
+			yield indent_self
+			yield node.get_style("reset")
+			yield from node.render_self(columns=columns, details_deadline=details_deadline)
 			yield "\n"
-			yield from children_rendering
 
-	def render_self(self):
+	def compute_shown(self, node_filter):
+		"""
+		Bottom-up pass deciding which nodes produce output, so that every node is checked against the filters once. Once
+		a node is matched by `include_pids`, its whole subtree is rendered without filtering and isn't in the result.
+		"""
+		is_shown = {}
+		if node_filter.is_empty():
+			return is_shown
+		stack = [(self, False)]
+		while stack:
+			node, children_are_done = stack.pop()
+			if children_are_done:
+				is_shown[node] = node_filter.is_explicitly_included(node) or any(is_shown[c] for c in node.children)
+			elif node_filter.is_pruned(node):
+				is_shown[node] = False
+			elif node_filter.unfilters_descendants(node):
+				is_shown[node] = node_filter.is_explicitly_included(node) or node.has_children()
+			else:
+				stack.append((node, True))
+				stack.extend((c, False) for c in node.children)
+		return is_shown
+
+	def render_self(self, *, columns=None, details_deadline=None):
 		if self.is_blank():
 			yield "(blank)"
 			return
-		yield self.get_style("pid")
+		yield self.get_style(self.churn_style or "pid")
 		yield "{}".format(self.pid)
 		yield self.get_style("reset")
 		yield " "
@@ -397,9 +1177,26 @@ class TreeNode(object):
 		yield self.user
 		yield self.get_style("reset")
 		yield " "
-		yield self.get_style("cmd")
+		if columns:
+			yield self.get_style("details")
+			yield "[{}]".format(" ".join(
+				"{}: {}".format(name, self.get_detail(name, deadline=details_deadline)) for name in columns
+			))
+			yield self.get_style("reset")
+			yield " "
+		yield self.get_style(self.churn_style or "cmd")
 		yield self.args
 		yield self.get_style("reset")
+		if self.rollup is not None:
+			yield " "
+			yield self.get_style("rollup")
+			yield "[Σ rss: {} cpu: {} threads: {} processes: {}]".format(
+				self.rollup.rss,
+				datetime.timedelta(seconds=round(self.rollup.cputime)),
+				self.rollup.threads,
+				self.rollup.count,
+			)
+			yield self.get_style("reset")
 
 
 def parse_args(*, args, prog, _args_file_already_loaded=False):
@@ -440,7 +1237,79 @@ def parse_args(*, args, prog, _args_file_already_loaded=False):
 		"--not-command", "-C", dest="exclude_commands", action="append", metavar="REGEX", type=str, default=[],
 		help="only include processes whose commands are not matching specified regular expressions"
 	)
+	parser.add_argument(
+		"--started-within", dest="started_within", action="store", metavar="DURATION", type=parse_duration, default=None,
+		help="only show processes started within specified time, such as 90s, 5m or 1h30m, and their ancestors"
+	)
+	parser.add_argument(
+		"--older-than", dest="older_than", action="store", metavar="DURATION", type=parse_duration, default=None,
+		help="only show processes started longer than specified time ago, such as 12h or 2d, and their ancestors"
+	)
+	parser.add_argument(
+		"--order-by", dest="order_by", action="store", choices=sorted(NODE_ORDER_KEYS), default=None,
+		help="order sibling processes by pid or start time"
+	)
+	parser.add_argument(
+		"--top", dest="top", action="store", metavar="N", type=int, default=None,
+		help="only show N heaviest process subtrees and their heavy branches, with subtree totals"
+	)
+	parser.add_argument(
+		"--sort", dest="sort_key", action="store", choices=sorted(ROLLUP_SORT_KEYS), default="rss",
+		help="subtree total to rank --top subtrees by"
+	)
+	parser.add_argument(
+		"--record", dest="record", action="store", metavar="NDJSON_FILE_PATH", type=pathlib.Path, default=None,
+		help="append a snapshot of all processes to the file every --interval until interrupted"
+	)
+	parser.add_argument(
+		"--replay", dest="replay", action="store", metavar="NDJSON_FILE_PATH", type=pathlib.Path, default=None,
+		help="show snapshots recorded with --record instead of current processes, the last one by default"
+	)
+	parser.add_argument(
+		"--at", dest="replay_at", action="store", metavar="ISO_TIME", type=datetime.datetime.fromisoformat, default=None,
+		help="show the last snapshot recorded at or before specified time"
+	)
+	parser.add_argument(
+		"--from", dest="replay_from", action="store", metavar="ISO_TIME", type=datetime.datetime.fromisoformat, default=None,
+		help="play back all snapshots recorded since specified time, one every --interval"
+	)
+	parser.add_argument(
+		"--to", dest="replay_to", action="store", metavar="ISO_TIME", type=datetime.datetime.fromisoformat, default=None,
+		help="play back all snapshots recorded until specified time, one every --interval"
+	)
+	parser.add_argument(
+		"--host", "-H", dest="hosts", action="append", metavar="HOST", type=str, default=[],
+		help="show processes of specified hosts instead of the local one, one forest per host"
+	)
+	parser.add_argument(
+		"--merge", dest="merge", action="store_true", default=False,
+		help="with --host, group processes of all hosts by --command patterns instead of one forest per host"
+	)
+	parser.add_argument(
+		"--transport", dest="transport", action="store", choices=sorted(HOST_TRANSPORTS), default="ssh",
+		help="how to run `ps` on --host hosts"
+	)
+	parser.add_argument(
+		"--timeout", dest="timeout", action="store", metavar="SECONDS", type=float, default=10.0,
+		help="give up on a --host host that hasn't responded in time"
+	)
+	parser.add_argument(
+		"--max-connections", dest="max_connections", action="store", metavar="COUNT", type=int, default=16,
+		help="maximum number of --host hosts to connect to at the same time"
+	)
+	parser.add_argument(
+		"--column", dest="columns", action="append", metavar="NAME", choices=list(DETAIL_COLUMNS), default=[],
+		help="show an extra column, one of: {}".format(", ".join(DETAIL_COLUMNS))
+	)
 	opts = parser.parse_args(args)
+	if opts.columns and (opts.hosts or opts.replay or not sys.platform.startswith("linux")):
+		parser.error("--column is only available for local processes on Linux")
+	if opts.hosts and (opts.watch or opts.record or opts.replay):
+		parser.error("--host can't be used with --watch, --record or --replay")
+	if opts.replay_at is not None and (opts.replay_from is not None or opts.replay_to is not None):
+		parser.error("--at can't be used with --from or --to")
+	if opts.merge and not opts.include_commands:
+		parser.error("--merge requires at least one --command")
 	opts.exclude_pids = [os.getpid() if pid == -1 else pid for pid in opts.exclude_pids]
 	if opts.args_file and not _args_file_already_loaded:
 		with opts.args_file.open("r") as fo: